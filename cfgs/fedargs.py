@@ -10,6 +10,7 @@ class FedArgs():
     def __init__(self):
         self.name = "client-x"
         self.num_clients = 100
+        self.client_fraction = 1.0 # C, fraction of clients sampled per round
         self.epochs = 51
         self.local_rounds = 1
         self.client_batch_size = 32
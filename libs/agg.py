@@ -1,14 +1,14 @@
 import copy, enum, torch
 import math
 import numpy as np
-from functools import reduce, partial
+from functools import partial
 import multiprocessing
 from multiprocessing import Pool, Process
-import sklearn.metrics.pairwise as smp
+from multiprocessing.pool import ThreadPool
 
 import os, sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../")))
-from libs import sim, log
+from libs import sim, log, stacked
 
 class Rule(enum.Enum):
     FedAvg = 0
@@ -63,218 +63,339 @@ def scale_model(model, scale):
     scaled_model.load_state_dict(params, strict=False)
     return scaled_model
 
-def FedAvg(base_model, models):
-    model_list = list(models.values())
-    model = reduce(add_model, model_list)
-    model = scale_model(model, 1.0 / len(models))
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
-
-def FedVal(base_model, models, **kwargs):
-    model_list = list(models.values()) # this is list of client model updates.
-    n_clients = len(model_list)
-    labels = 10 # assuming for 10-class classification problem
+class UpdateMatrix():
+    '''Client updates of a round as one contiguous float32 n x d tensor.
+
+    Row i is the flattened parameters of the i-th model in `models`, laid out
+    by sim.get_layout. Non parameter state (e.g. batchnorm running stats) is
+    small and kept stacked per client, each rule reduces it the way it
+    reduces the parameters, see reduce_buffers.
+    '''
+    def __init__(self, models):
+        self.keys = list(models.keys())
+        model_list = list(models.values())
+        self.template = model_list[0]
+        self.layout = sim.get_layout(self.template)
+
+        self.n = len(model_list)
+        self.d = self.layout.d
+        self.arr = torch.empty((self.n, self.d), dtype=torch.float32)
+        for index, model in enumerate(model_list):
+            self.layout.flatten(model, self.arr[index])
+
+        self._gram = None
+        self._sq_dists = None
+
+        self.buffers = stack_buffers([dict(model.named_buffers()) for model in model_list])
+
+    @classmethod
+    def from_arr(cls, arr, template, keys=None, buffers=None):
+        # wrap updates that are already flat, rows in the layout of template
+        um = cls.__new__(cls)
+        um.keys = list(range(arr.shape[0])) if keys is None else list(keys)
+        um.template = template
+        um.layout = sim.get_layout(template)
+        um.n, um.d = arr.shape
+        um.arr = arr
+        um._gram = None
+        um._sq_dists = None
+        um.buffers = {} if buffers is None else buffers
+        return um
+
+    def flatten(self, model):
+        return self.layout.flatten(model)
+
+    def chunks(self, chunk_size=None):
+        # coordinate ranges of the matrix, about 2^22 entries at a time by default
+        if chunk_size is None:
+            chunk_size = max(1, (1 << 22) // self.n)
+        for start_index in range(0, self.d, chunk_size):
+            end_index = min(start_index + chunk_size, self.d)
+            yield start_index, end_index, self.arr[:, start_index:end_index]
+
+    def gram(self, block_size=1024):
+        # float64, cached for the round, shared by Krum, M_Krum and FoolsGold
+        if self._gram is None:
+            self._gram = sim.gram(self.arr, block_size)
+        return self._gram
+
+    def sq_dists(self, block_size=1024):
+        if self._sq_dists is None:
+            self._sq_dists = sim.gram_sq_dists(self.gram(block_size))
+        return self._sq_dists
+
+    def reduce_buffers(self, weights=None, reduce=None):
+        # buffer updates over the clients, by reduce(n x ... tensor), by client
+        # weights normalized to sum to one, or the plain mean
+        if weights is not None:
+            weights = weights.float()
+            total = weights.sum()
+            weights = weights / total if total > 0 else torch.full((self.n,), 1.0 / self.n)
+        buffers = {}
+        with torch.no_grad():
+            for name, arr in self.buffers.items():
+                if reduce is not None:
+                    buffers[name] = reduce(arr)
+                elif weights is not None:
+                    buffers[name] = torch.tensordot(weights, arr, dims=1)
+                else:
+                    buffers[name] = arr.mean(0)
+        return buffers
+
+    def to_model(self, arr, base_model=None, buffers=None):
+        # arr is an aggregated update, the next global model is base_model - arr,
+        # buffers the aggregated buffer updates, by default their client mean
+        if buffers is None:
+            buffers = self.reduce_buffers()
+        model = copy.deepcopy(self.template if base_model is None else base_model)
+        self.layout.assign(model, arr, alpha=None if base_model is None else -1)
+        with torch.no_grad():
+            for name, buffer in model.named_buffers():
+                if name in buffers:
+                    value = buffers[name] if base_model is None else buffer.float() - buffers[name]
+                    buffer.copy_(value)
+        return model
+
+def stack_buffers(model_buffers):
+    # list of {name: buffer} per client to {name: n x ... float tensor}
+    with torch.no_grad():
+        return {name: torch.stack([buffers[name].float() for buffers in model_buffers])
+                for name in (model_buffers[0] if len(model_buffers) > 0 else {})}
+
+class Streaming():
+    '''Folds client updates into the aggregate as they arrive, O(d) server memory.
+
+    For rules that need no other client's update to weigh one: FedAvg, with
+    optional norm clipping (clip_norm kwarg), and FLTrust, whose reference
+    update is known before clients report. Use begin_round, add per client,
+    then finalize for the next global model.
+    '''
+    def __init__(self, rule=Rule.FedAvg):
+        if rule not in [Rule.FedAvg, Rule.FLTrust]:
+            raise ValueError("{} can not be aggregated as a stream".format(rule))
+        self.rule = rule
+
+    def begin_round(self, base_model, **kwargs):
+        self.base_model = base_model
+        self.layout = sim.get_layout(base_model)
+        self.arr = torch.zeros(self.layout.d, dtype=torch.float32)
+        self.update_arr = torch.empty(self.layout.d, dtype=torch.float32)
+        self.buffers = {name: torch.zeros(buffer.shape) for name, buffer in base_model.named_buffers()}
+        self.clients = []
+        self.scores = []
+        self.weight = 0.0
+
+        self.clip_norm = kwargs["clip_norm"] if "clip_norm" in kwargs else None
+        if self.rule is Rule.FLTrust:
+            self.base_norm = kwargs["base_norm"] if "base_norm" in kwargs else True
+            self.base_arr = self.layout.flatten(kwargs["base_model_update"])
+            self.base_model_update_norm = torch.norm(self.base_arr).item()
+
+    def add(self, client, update):
+        self.layout.flatten(update, self.update_arr)
+        norm = torch.norm(self.update_arr).item()
+
+        weight, scale = 1.0, 1.0
+        if self.rule is Rule.FedAvg and self.clip_norm is not None and norm > self.clip_norm:
+            scale = self.clip_norm / norm
+        if self.rule is Rule.FLTrust:
+            # Relu
+            weight = max(torch.dot(self.update_arr, self.base_arr).item() / (norm * self.base_model_update_norm), 0)
+            scale = weight * self.base_model_update_norm / norm if self.base_norm else weight
+            self.scores.append(weight)
+
+        self.arr.add_(self.update_arr, alpha=scale)
+        self.weight += weight
+        with torch.no_grad():
+            for name, buffer in update.named_buffers():
+                if name in self.buffers:
+                    self.buffers[name] += buffer.float() * weight
+        self.clients.append(client)
+
+    def finalize(self):
+        if self.rule is Rule.FLTrust:
+            log.info("Cosine Score {}".format(self.scores))
+
+        model = copy.deepcopy(self.base_model)
+        self.layout.assign(model, self.arr, alpha=-1.0 / self.weight)
+        with torch.no_grad():
+            for name, buffer in model.named_buffers():
+                if name in self.buffers:
+                    # buffers weighted like the updates, by the FLTrust score
+                    buffer.copy_(buffer.float() - self.buffers[name] / self.weight)
+        return model
+
+class UpdateStore():
+    '''Client updates of a round in a memory-mapped n x d float32 .npy file.
+
+    Same begin_round / add / finalize calls as Streaming, for any rule. Rows
+    are filled in arrival order and the file is reused every round; rules
+    read it through UpdateMatrix.chunks, so coordinate-wise rules (Median,
+    T_Mean, FLTC) run out of core with about chunk_size x n floats in RAM.
+    '''
+    def __init__(self, path, model, max_clients, rule=Rule.FedAvg):
+        self.path = path
+        self.template = model
+        self.layout = sim.get_layout(model)
+        self.rule = rule
+        self.arr = torch.from_numpy(np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                                              shape=(max_clients, self.layout.d)))
+        self.keys = []
+        self.buffers = []
+
+    def begin_round(self, base_model, **kwargs):
+        self.base_model = base_model
+        self.kwargs = kwargs
+        self.keys = []
+        self.buffers = []
+
+    def add(self, client, update):
+        self.layout.flatten(update, self.arr[len(self.keys)])
+        self.buffers.append({name: buffer.detach().clone() for name, buffer in update.named_buffers()})
+        self.keys.append(client)
+
+    def matrix(self):
+        return UpdateMatrix.from_arr(self.arr[:len(self.keys)], self.template, self.keys, stack_buffers(self.buffers))
+
+    def finalize(self):
+        return aggregate(self.matrix(), self.base_model, self.rule, **self.kwargs)
+
+def FedAvg(base_model, um, **kwargs):
+    return um.to_model(um.arr.mean(0), base_model)
+
+def FedVal(base_model, um, **kwargs):
+    labels = kwargs["labels"] if "labels" in kwargs else 10 # assuming for 10-class classification problem
+    # client models per batched pass, chunk_size of the other rules counts coordinates
+    eval_chunk_size = kwargs["eval_chunk_size"] if "eval_chunk_size" in kwargs else 16
     
     # for now, assumed these two hyperparameters as done in the original code base.
     s1_overall = 2
     s1 = 3
     s2 = 3
     
-    scores = [0.0 for i in range(n_clients)] # to keep final trust scores of each client model udpate.
-    loss_dict = {} # to keep avg loss for each client model update.
-    label_loss_dict = {} # to keep label wise loss for each client model update.
-    
     # To test, kept one batch as the data owned by the server.
     x_test, y_test = next(iter(kwargs["val_data_loader"]))
 
-    # now, calculate avg loss and label wise loss for each client model update, similar to original code base.
-    for index, model in enumerate(model_list):
-        preds = model(x_test)
-        spec_label_correct_count = [0.0 for i in range(labels)]
-        spec_label_all_count = [0.0 for i in range(labels)]
-        spec_label_loss_count = [0.0 for i in range(labels)]
-
-        for i in range(len(preds)):
-            pred = np.argmax(preds[i].detach().numpy())
-            true = y_test[i]
-            spec_label_all_count[true] = spec_label_all_count[true] + 1
-            spec_label_loss_count[true] += -(math.log(max(preds[i][true],0.0001)))
-            if true == pred:
-                spec_label_correct_count[true] = spec_label_correct_count[true] +1
-
-        spec_label_accuracy = []
-        spec_label_loss = []
-        all_sum = 0
-        all_acc_correct = 0
-        all_loss_correct = 0
-        
-        for i in range(len(spec_label_all_count)):
-            all_sum += spec_label_all_count[i]
-            spec_label_accuracy.append(spec_label_correct_count[i]/spec_label_all_count[i])
-            all_acc_correct += spec_label_correct_count[i]
-            spec_label_loss.append(spec_label_loss_count[i]/spec_label_all_count[i])
-            all_loss_correct += spec_label_loss_count[i]
-
-        loss_dict[index] = np.mean(spec_label_loss)
-        label_loss_dict[index] = spec_label_loss
-
-    print("loss_dict", loss_dict)
-    print("label_loss_dict", label_loss_dict)
+    # label wise loss for each client model update, all client updates in one batched pass.
+    label_loss, _ = stacked.evaluate_labels(um.template, um.arr, x_test, y_test, labels, eval_chunk_size)
+    # only the labels the batch has, a missing label would score every client by 0 / 0
+    label_loss = label_loss[:, torch.bincount(y_test.long(), minlength=labels) > 0]
+    loss = label_loss.mean(1)
+
+    print("loss_dict", dict(enumerate(loss.tolist())))
+    print("label_loss_dict", dict(enumerate(label_loss.tolist())))
         
-    # code to calculate the overall mad and slope.
-    mean_calc = []
-    for elem in loss_dict:
-        mean_calc.append(loss_dict[elem])
-    mean = np.mean(mean_calc)
-    
-    all_for_score = []
-    for elem in mean_calc:
-        #if loss then (mean - elem), if accuracy (mean - elem)
-        all_for_score.append(mean - elem)
-    mad_calc = all_for_score.copy()
-
-    for j in range(len(mad_calc)):
-        mad_calc[j] = abs(mad_calc[j])
-    no_elems = round(len(mad_calc))
-    mad_calc.sort()
-    mad_calc = mad_calc[:no_elems]
-    mad = np.mean(mad_calc)
-
-    slope = s1_overall/mad
-    
-    for k in range(len(all_for_score)):
-        scores[k] = scores[k] + slope*all_for_score[k] + 10
-    overall_mean = mean # before proceeding, store mean in overall mean.
+    # overall mad and slope, if loss then (mean - elem)
+    overall_mean = loss.mean()
+    all_for_score = overall_mean - loss
+    slope = s1_overall / all_for_score.abs().mean()
+    scores = slope * all_for_score + 10
         
     # label-wise trust scores calculated, followed by final trust score aggregation.
-    for label in range(labels):
-        mean_calc = []
-        for elem in label_loss_dict:
-            mean_calc.append(label_loss_dict.get(elem)[label])
-        mean = np.mean(mean_calc)
-
-        all_for_score = []
-        for elem in mean_calc:
-            all_for_score.append(mean - elem)
-        mad_calc = all_for_score.copy()
-
-        for j in range(len(mad_calc)):
-            mad_calc[j] = abs(mad_calc[j])
-        no_elems = round(len(mad_calc))
-        mad_calc.sort()
-        mad_calc = mad_calc[:no_elems]
-        mad = np.mean(mad_calc)
-
-        slope = s1/mad
-
-        dif = (mean - overall_mean)
-        x = ((overall_mean+dif)/overall_mean)
-        factor = x**s2
-
-        for k in range(len(all_for_score)):
-            scores[k] = scores[k] + (max(1,factor))*slope*all_for_score[k] + 10
+    mean = label_loss.mean(0)
+    all_for_score = mean[None, :] - label_loss
+    slope = s1 / all_for_score.abs().mean(0)
+    factor = torch.clamp((mean / overall_mean) ** s2, min=1)
+    scores = scores + (factor * slope * all_for_score + 10).sum(1)
             
-    print ("scores", scores)
+    print ("scores", scores.tolist())
     
     # model aggregation
-    updated_model_list = []
-    for index, model in enumerate(model_list):
-        model = scale_model(model, scores[index])
-        updated_model_list.append(model)
-        
-    model = reduce(add_model, updated_model_list)
-    model = scale_model(model, 1.0 / sum(scores))
+    scores = scores.float()
+    model_arr = torch.matmul(scores, um.arr) / scores.sum()
 
     # next global model
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
-
-def FoolsGold(base_model, models, **kwargs):
-    len_grad = len(sim.get_net_arr(base_model)[0])
-    model_list = list(models.values())
-    n_clients = len(model_list)
-    
-    grads = np.zeros((n_clients, len_grad))
-    for index, model in enumerate(model_list):
-        grads[index] = sim.get_net_arr(model)[0]
+    return um.to_model(model_arr, base_model, um.reduce_buffers(scores))
+
+class FoolsGoldHistory():
+    '''Running sum of every client's updates across rounds, as in the FoolsGold paper.
+
+    The n x d history can live in a memory-mapped .npy file (path). Its Gram
+    matrix is kept up to date incrementally, so a round costs one n x m x d
+    product for the m clients that reported instead of a full recompute.
+    '''
+    def __init__(self, clients, model, path=None):
+        self.index = {client: index for index, client in enumerate(clients)}
+        shape = (len(clients), sim.get_layout(model).d)
+        self.memmap = None
+        if path is None:
+            self.arr = torch.zeros(shape, dtype=torch.float32)
+        else:
+            self.memmap = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+            self.arr = torch.from_numpy(self.memmap)
+        self.gram = torch.zeros((shape[0], shape[0]), dtype=torch.float64)
+
+    def update(self, um):
+        # (H + U)(H + U)^T = G + H U^T + U H^T + U U^T, rows of this round only
+        rows = torch.tensor([self.index[key] for key in um.keys])
+        # H U^T in float64 like sim.gram, over coordinate chunks of about 2^22 history entries
+        cross = torch.zeros((self.arr.shape[0], um.n), dtype=torch.float64)
+        for start_index, end_index, chunk in um.chunks(max(1, (1 << 22) // self.arr.shape[0])):
+            cross.addmm_(self.arr[:, start_index:end_index].double(), chunk.double().t())
+        self.gram.index_add_(1, rows, cross)
+        self.gram.index_add_(0, rows, cross.t())
+        self.gram[rows[:, None], rows[None, :]] += um.gram()
+        self.arr.index_add_(0, rows, um.arr)
+        return self.gram[rows[:, None], rows[None, :]]
+
+def foolsgold_weights(_gram):
+    n_clients = _gram.shape[0]
+    norms = torch.sqrt(torch.diagonal(_gram))
+    norms[norms == 0] = 1
+    cs = _gram / (norms[:, None] * norms[None, :]) - torch.eye(n_clients, dtype=_gram.dtype)
+    maxcs = torch.max(cs, dim=1).values
 
-    cs = smp.cosine_similarity(grads) - np.eye(n_clients)
-    maxcs = np.max(cs, axis=1)
-    
     # pardoning
-    for i in range(n_clients):
-        for j in range(n_clients):
-            if i == j:
-                continue
-            if maxcs[i] < maxcs[j]:
-                cs[i][j] = cs[i][j] * maxcs[i] / maxcs[j]
-    wv = 1 - (np.max(cs, axis=1))
+    pardon = maxcs[:, None] < maxcs[None, :]
+    cs = torch.where(pardon, cs * maxcs[:, None] / maxcs[None, :], cs)
+    wv = 1 - torch.max(cs, dim=1).values
     wv[wv > 1] = 1
     wv[wv < 0] = 0
 
     # Rescale so that max value is wv
-    wv = wv / np.max(wv)
+    wv = wv / torch.max(wv)
     wv[(wv == 1)] = .99
     
     # Logit function
-    wv = (np.log(wv / (1 - wv)) + 0.5)
-    wv[(np.isinf(wv) + wv > 1)] = 1
+    wv = (torch.log(wv / (1 - wv)) + 0.5)
+    wv[(torch.isinf(wv) + wv > 1)] = 1
     wv[(wv < 0)] = 0
+    return wv
 
-    updated_model_list = []
-    for index, model in enumerate(model_list):
-        model = scale_model(model, wv[index])
-        updated_model_list.append(model)
-                                  
-    model = reduce(add_model, updated_model_list)
-    model = scale_model(model, 1.0 / len(models))
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
+def FoolsGold(base_model, um, **kwargs):
+    # with a FoolsGoldHistory similarity is over the clients' aggregate history, else this round only
+    history = kwargs["history"] if "history" in kwargs else None
+    _gram = um.gram() if history is None else history.update(um)
+    wv = foolsgold_weights(_gram)
 
-def FLTrust(base_model, models, **kwargs):
+    model_arr = torch.matmul(wv.float(), um.arr) / um.n
+    return um.to_model(model_arr, base_model, um.reduce_buffers(wv))
+
+def FLTrust(base_model, um, **kwargs):
     base_model_update = kwargs["base_model_update"]
     base_norm = kwargs["base_norm"] if "base_norm" in kwargs else True
 
-    if base_norm:
-        # Base Model Norm
-        base_model_update_norm = sim.grad_norm(base_model_update)
-    
-    model_list = list(models.values())
-    ts_score_list=[]
-    fl_score_list=[]
-    updated_model_list = []
-    for model in model_list:
-        ts_score = sim.grad_cosine_similarity(base_model_update, model)
-
-        # Relu
-        if ts_score < 0:
-            ts_score = 0
-        ts_score_list.append(ts_score)
-
-        if base_norm:
-            # Model Norm    
-            norm = sim.grad_norm(model)
-            ndiv = base_model_update_norm/norm
-            scale_norm = ts_score * ndiv
-            model = scale_model(model, scale_norm)
-            fl_score_list.append(scale_norm)
-        else:
-            model = scale_model(model, ts_score)
+    base_arr = um.flatten(base_model_update)
+    # Base Model Norm
+    base_model_update_norm = torch.norm(base_arr)
+    norms = torch.norm(um.arr, dim=1)
 
-        updated_model_list.append(model)
+    # Relu
+    ts_scores = torch.clamp(torch.mv(um.arr, base_arr) / (norms * base_model_update_norm), min=0)
+    ts_score_list = ts_scores.tolist()
+    fl_score_list = []
+
+    weights = ts_scores
+    if base_norm:
+        # Model Norm
+        weights = ts_scores * (base_model_update_norm / norms)
+        fl_score_list = weights.tolist()
 
     log.info("Cosine Score {}".format(ts_score_list))
     log.info("FLTrust Score {}".format(fl_score_list))
-        
-    model = reduce(add_model, updated_model_list)
-    model = scale_model(model, 1.0 / sum(ts_score_list))
 
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
+    model_arr = torch.matmul(weights, um.arr) / ts_scores.sum()
+    return um.to_model(model_arr, base_model, um.reduce_buffers(ts_scores))
 
 def get_trusted_components(eucliden_dist, no_of_clients, params):
     b_arr = params[0]
@@ -298,197 +419,196 @@ def get_trusted_components(eucliden_dist, no_of_clients, params):
         trusted_component = sum((m_arr * client_score) / sum(client_score))
     return (trusted_component, client_score)
     
-def FLTC(base_model, models, **kwargs):
+def trusted_components(b_arr, m_arr, eucliden_dist):
+    # get_trusted_components for a chunk of coordinates at once, b_arr is c and m_arr is n x c
+    a_euc_score = (b_arr[None, :] - m_arr) / eucliden_dist[:, None]
+    sign_p = a_euc_score > 0
+    sign_n = a_euc_score < 0
+    trusted = torch.where(sign_p.sum(0) > sign_n.sum(0), sign_p, sign_n)
+
+    a_min = a_euc_score.masked_fill(~trusted, math.inf).min(0).values
+    a_max = a_euc_score.masked_fill(~trusted, -math.inf).max(0).values
+    a_range = a_max - a_min
+    # like sim.min_max_norm, scores stay as they are when max == min
+    client_score = torch.where(a_range != 0, (a_euc_score - a_min) / a_range, a_euc_score)
+    client_score = client_score.masked_fill(~trusted | (trusted.sum(0) < 2), 0)
+
+    score_sum = client_score.sum(0)
+    trusted_component = torch.where(score_sum > 0, (m_arr * client_score / score_sum).sum(0), b_arr)
+    return trusted_component, client_score.sum(1)
+
+def FLTC(base_model, um, **kwargs):
     base_model_update = kwargs["base_model_update"]
-    base_model_arr, b_list = sim.get_net_arr(base_model_update)
+    chunk_size = kwargs["chunk_size"] if "chunk_size" in kwargs else None
+    base_arr = um.flatten(base_model_update).double()
 
-    eucliden_dist = []
-    updated_model_list = []
+    eucliden_dist = torch.zeros(um.n, dtype=torch.float64)
+    for start_index, end_index, chunk in um.chunks(chunk_size):
+        eucliden_dist += ((base_arr[start_index:end_index] - chunk.double()) ** 2).sum(1)
+    eucliden_dist = torch.sqrt(eucliden_dist)
 
-    for model in list(models.values()):
-        model_arr, _ = sim.get_net_arr(model)
-        updated_model_list.append(model_arr)
-        eucliden_dist.append(sim.eucliden_dist(base_model_arr, model_arr))
-    eucliden_dist = np.array(eucliden_dist)
+    model_arr = torch.empty(um.d, dtype=torch.float64)
+    client_scores = torch.zeros(um.n, dtype=torch.float64)
+    for start_index, end_index, chunk in um.chunks(chunk_size):
+        trusted_component, client_score = trusted_components(base_arr[start_index:end_index], chunk.double(), eucliden_dist)
+        model_arr[start_index:end_index] = trusted_component
+        client_scores += client_score
 
-    updated_model_tensors = torch.tensor(updated_model_list)
-    merged_updated_model_tensors = torch.stack([model for model in updated_model_tensors], 0)
-    merged_updated_model_arrs = torch.transpose(merged_updated_model_tensors, 0, 1).numpy()
+    client_scores = client_scores / um.d
+    log.info("FLTC Score {}".format(client_scores.numpy()))
+
+    return um.to_model(model_arr.float(), base_model, um.reduce_buffers(client_scores))
+
+def FLTC_reference(base_model, um, **kwargs):
+    # one process pool task per coordinate, kept only to check FLTC against
+    base_model_update = kwargs["base_model_update"]
+    base_arr = um.flatten(base_model_update)
+    base_model_arr = base_arr.numpy()
+
+    eucliden_dist = np.array([torch.norm(base_arr - model_arr).item() for model_arr in um.arr])
+    merged_updated_model_arrs = um.arr.t().numpy()
     
     with Pool(min(multiprocessing.cpu_count(), 20)) as p:
-        func = partial(get_trusted_components, eucliden_dist, len(models))
-        trusted_components = p.map(func, [(b_arr, m_arr) for b_arr, m_arr in zip(base_model_arr, merged_updated_model_arrs)])
+        func = partial(get_trusted_components, eucliden_dist, um.n)
+        _trusted_components = p.map(func, [(b_arr, m_arr) for b_arr, m_arr in zip(base_model_arr, merged_updated_model_arrs)])
         p.close()
         p.join()
         
     model_arr = np.zeros(len(base_model_arr))
-    client_scores = np.zeros(len(models))    
+    client_scores = np.zeros(um.n)
 
-    for index, (trusted_component, client_score) in enumerate(trusted_components):
+    for index, (trusted_component, client_score) in enumerate(_trusted_components):
         model_arr[index] = trusted_component
         client_scores = client_scores + client_score
 
     client_scores = client_scores / len(base_model_arr)
     log.info("FLTC Score {}".format(client_scores))
     
-    model = sim.get_arr_net(base_model_update, model_arr, b_list)
-    
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
-
-def Krum(base_model, models, **kwargs):
-    model_list = list(models.values())
-    model_keys = list(models.keys())
+    return um.to_model(torch.from_numpy(model_arr).float(), base_model, um.reduce_buffers(torch.from_numpy(client_scores)))
 
-    beta = kwargs["beta"]
+def krum_scores(um, beta):
     lb = beta//2
-    ub = len(model_list) - beta//2 - 1
-    
-    euclidean_dists = []
-    for index1, model1 in enumerate(model_list):
-        model_dists = []
-        for index2, model2 in enumerate(model_list):
-            if index1 != index2:
-                dist = sim.grad_eucliden_dist(model1, model2)
-                model_dists.append(dist)
-        sq_dists = torch.sum(torch.sort(torch.tensor(model_dists)).values[lb:ub])
-        euclidean_dists.append(sq_dists)
-    
-    min_model_index = euclidean_dists.index(min(euclidean_dists)) 
-    log.info("Krum Candidate is {}".format(model_keys[min_model_index]))
+    ub = um.n - beta//2 - 1
 
-    model = model_list[min_model_index]
-    if base_model is not None:
-        model = sub_model(base_model, model_list[min_model_index])
-    return model
+    # drop the zero distance of each model to itself, sum the lb:ub closest others
+    euclidean_dists = torch.sqrt(um.sq_dists())
+    euclidean_dists = torch.sort(euclidean_dists, dim=1).values[:, 1:]
+    return torch.sum(euclidean_dists[:, lb:ub], dim=1)
 
-def M_Krum(base_model, models, **kwargs):
-    model_list = list(models.values())
-    model_keys = list(models.keys())
+def Krum(base_model, um, **kwargs):
+    euclidean_dists = krum_scores(um, kwargs["beta"])
+    
+    min_model_index = torch.argmin(euclidean_dists).item()
+    log.info("Krum Candidate is {}".format(um.keys[min_model_index]))
+
+    weights = torch.zeros(um.n)
+    weights[min_model_index] = 1.0
+    return um.to_model(um.arr[min_model_index], base_model, um.reduce_buffers(weights))
 
+def M_Krum(base_model, um, **kwargs):
     beta = kwargs["beta"]
-    lb = beta//2
-    ub = len(model_list) - beta//2 - 1
-
-    euclidean_dists = []
-    for index1, model1 in enumerate(model_list):
-        model_dists = []
-        for index2, model2 in enumerate(model_list):
-            if index1 != index2:
-                dist = sim.grad_eucliden_dist(model1, model2)
-                model_dists.append(dist)
-        sq_dists = torch.sum(torch.sort(torch.tensor(model_dists)).values[lb:ub])
-        euclidean_dists.append(sq_dists)
+    euclidean_dists = krum_scores(um, beta)
             
-    min_model_indices = np.argpartition(np.array(euclidean_dists), len(model_list) - 2*beta - 2)
-    min_model_indices = min_model_indices[:len(model_list) - 2*beta - 2]
-    log.info("M_Krum Candidates are {}".format([model_keys[index] for index in min_model_indices]))
+    min_model_indices = np.argpartition(euclidean_dists.numpy(), um.n - 2*beta - 2)
+    min_model_indices = min_model_indices[:um.n - 2*beta - 2]
+    log.info("M_Krum Candidates are {}".format([um.keys[index] for index in min_model_indices]))
     
-    model_list = [model for index, model in enumerate(model_list) if index in min_model_indices]
+    weights = torch.zeros(um.n)
+    weights[min_model_indices] = 1.0 / um.n
+    return um.to_model(torch.matmul(weights, um.arr), base_model, um.reduce_buffers(weights))
 
-    model = reduce(add_model, model_list)
-    model = scale_model(model, 1.0 / len(models))
+def Median(base_model, um, **kwargs):
+    chunk_size = kwargs["chunk_size"] if "chunk_size" in kwargs else None
 
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
+    # same as np.median, mean of the two middle values for even n
+    lk = (um.n + 1) // 2
+    uk = um.n // 2 + 1
 
-def Median(base_model, models, **kwargs):
-    model_list = list(models.values())
-    dummy_model = model_list[0]
-    dummy_model_arr, d_list = sim.get_net_arr(dummy_model)
+    model_arr = torch.empty(um.d, dtype=torch.float32)
+    for start_index, end_index, chunk in um.chunks(chunk_size):
+        median = torch.kthvalue(chunk, lk, dim=0).values
+        if uk != lk:
+            median = (median + torch.kthvalue(chunk, uk, dim=0).values) / 2
+        model_arr[start_index:end_index] = median
 
+    buffers = um.reduce_buffers(reduce=lambda arr: arr.quantile(0.5, dim=0))
+    return um.to_model(model_arr, base_model, buffers)
+
+def T_Mean(base_model, um, **kwargs):
     beta = kwargs["beta"]
+    chunk_size = kwargs["chunk_size"] if "chunk_size" in kwargs else None
     lb = beta
-    ub = len(model_list) - beta
+    ub = um.n - beta
 
-    updated_model_list = []
-    for model in model_list:
-        model_arr, _ = sim.get_net_arr(model)
-        updated_model_list.append(model_arr)
-        
-    updated_model_tensors = torch.tensor(updated_model_list)
-    merged_updated_model_tensors = torch.sort(torch.stack([model for model in updated_model_tensors], 0), dim = 0)
-    merged_updated_model_arrs = torch.transpose(merged_updated_model_tensors.values, 0, 1).numpy()
-    merged_updated_model_indices = torch.transpose(merged_updated_model_tensors.indices, 0, 1).numpy()
-
-    model_arr = np.zeros(len(dummy_model_arr))
-    for index, arr in enumerate(merged_updated_model_arrs):
-        model_arr[index] = np.median(arr)
-    model = sim.get_arr_net(dummy_model, model_arr, d_list)
-    
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
+    model_arr = torch.empty(um.d, dtype=torch.float32)
+    for start_index, end_index, chunk in um.chunks(chunk_size):
+        model_arr[start_index:end_index] = torch.sort(chunk, dim=0).values[lb:ub].mean(0)
 
-def T_Mean(base_model, models, **kwargs):
-    model_list = list(models.values())
-    dummy_model = model_list[0]
-    dummy_model_arr, d_list = sim.get_net_arr(dummy_model)
+    buffers = um.reduce_buffers(reduce=lambda arr: torch.sort(arr, dim=0).values[lb:ub].mean(0))
+    return um.to_model(model_arr, base_model, buffers)
 
-    beta = kwargs["beta"]
-    lb = beta
-    ub = len(model_list) - beta
+def dnc_bucket(all_updates, n_keep, idx):
+    sampled_all_updates = all_updates[:, idx]
+    centered_all_updates = sampled_all_updates - torch.mean(sampled_all_updates, 0)
 
-    updated_model_list = []
-    for model in model_list:
-        model_arr, _ = sim.get_net_arr(model)
-        updated_model_list.append(model_arr)
-        
-    updated_model_tensors = torch.tensor(updated_model_list)
-    merged_updated_model_tensors = torch.sort(torch.stack([model for model in updated_model_tensors], 0), dim = 0)
-    merged_updated_model_arrs = torch.transpose(merged_updated_model_tensors.values, 0, 1).numpy()
-    
-    model_arr = np.zeros(len(dummy_model_arr))
-    for index, arr in enumerate(merged_updated_model_arrs):
-        model_arr[index] = arr[lb:ub].mean(0)
-    model = sim.get_arr_net(dummy_model, model_arr, d_list)
-    
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
+    # only the top singular direction is needed, no full svd
+    v = sim.top_singular_vector(centered_all_updates)
+    scores = torch.mv(centered_all_updates, v)
 
-def DnC(base_model, models, **kwargs):
-    num_buckets=1
-    bucket=100000
-    all_updates = []
-    _list = None
-    
-    for model in list(models.values()):
-        model_arr, _list = sim.get_net_arr(model)
-        all_updates.append(model_arr)
-        
-    all_updates = torch.tensor(all_updates)
+    return set(torch.argsort(scores**2)[:n_keep].tolist())
+
+def DnC(base_model, um, **kwargs):
+    num_buckets = kwargs["num_buckets"] if "num_buckets" in kwargs else 1
+    if num_buckets < 1:
+        raise ValueError("DnC needs at least one bucket, got num_buckets {}".format(num_buckets))
+    bucket_size = kwargs["bucket_size"] if "bucket_size" in kwargs else 100000
+    all_updates = um.arr
     n, d = all_updates.shape
 
     n_attackers = kwargs["beta"]
+    n_keep = n - int(1.5 * n_attackers)
+    if n_keep < 1:
+        raise ValueError("DnC keeps no client of {} with beta {}".format(n, n_attackers))
 
-    final_indices = []
-    
-    for p in np.arange(num_buckets):
-        idx = np.sort(np.random.choice(d, bucket, replace=False))
-        sampled_all_updates = all_updates[:, idx]
-        sampled_good_updates = all_updates[n_attackers:][:, idx]
-
-        centered_all_updates = sampled_all_updates - torch.mean(sampled_all_updates, 0)
-        centered_good_updates = sampled_good_updates - torch.mean(sampled_good_updates, 0)
-        
-        u, s, v = torch.svd(centered_all_updates)
-        u_g, s_g, v_g = torch.svd(centered_good_updates)
-        
-        scores = torch.mm(centered_all_updates, v[:,0][:, None]).cpu().numpy()
-        
-        final_indices.append(list(np.argsort(scores[:,0]**2)[:(n-int(1.5*n_attackers))]))
+    # buckets drawn up front, then filtered in parallel, torch releases the GIL
+    idxs = [np.sort(np.random.choice(d, min(bucket_size, d), replace=False)) for _ in range(num_buckets)]
+    with ThreadPool(min(multiprocessing.cpu_count(), num_buckets)) as p:
+        final_indices = p.map(partial(dnc_bucket, all_updates, n_keep), idxs)
 
-    result = set(final_indices[0]) 
+    result = set(final_indices[0])
     for currSet in final_indices[1:]: 
         result.intersection_update(currSet)
-    final_idx = np.array(list(result))
-    # print(np.array(final_idx), len((final_idx)))
-    
-    model = sim.get_arr_net(base_model, torch.mean(all_updates[final_idx], 0).numpy(), _list)
-    
-    if base_model is not None:
-        model = sub_model(base_model, model)
-    return model
\ No newline at end of file
+    if not result:
+        # no client passed every bucket, keep those that passed the most
+        votes = torch.bincount(torch.tensor([index for currSet in final_indices for index in currSet]), minlength=n)
+        result = set(torch.flatnonzero(votes == votes.max()).tolist())
+        log.warning("DnC buckets share no client, kept the most voted")
+    final_idx = torch.tensor(sorted(result), dtype=torch.long)
+    log.info("DnC Candidates are {}".format([um.keys[index] for index in final_idx.tolist()]))
+
+    weights = torch.zeros(n)
+    weights[final_idx] = 1.0
+    return um.to_model(torch.mean(all_updates[final_idx], 0), base_model, um.reduce_buffers(weights))
+
+def aggregate(um, base_model=None, rule=Rule.FedAvg, **kwargs):
+    if rule is Rule.FedAvg:
+        model = FedAvg(base_model, um)
+    if rule is Rule.FedVal:
+        model = FedVal(base_model, um, **kwargs)
+    if rule is Rule.FoolsGold:
+        model = FoolsGold(base_model, um, **kwargs)
+    if rule is Rule.FLTrust:
+        model = FLTrust(base_model, um, **kwargs)
+    if rule is Rule.FLTC:
+        model = FLTC(base_model, um, **kwargs)
+    if rule is Rule.Krum:
+        model = Krum(base_model, um, **kwargs)
+    if rule is Rule.M_Krum:
+        model = M_Krum(base_model, um, **kwargs)
+    if rule is Rule.Median:
+        model = Median(base_model, um, **kwargs)
+    if rule is Rule.T_Mean:
+        model = T_Mean(base_model, um, **kwargs)
+    if rule is Rule.DnC:
+        model = DnC(base_model, um, **kwargs)
+    return model
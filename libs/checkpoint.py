@@ -0,0 +1,149 @@
+import copy, glob, os, pickle, random, shutil
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../")))
+from libs import sim
+
+# Round checkpoints of a federated run: the global model's flat weights and
+# buffers, the round, any extra state (aggregator history such as an
+# agg.FoolsGoldHistory, attack args such as cosine_attack["args"]) and the
+# torch, numpy and random RNG states, so a resumed run continues as if it
+# had not stopped.
+
+class Mapped():
+    '''A memory-mapped array in a snapshot, its file is copied by the writer.'''
+    def __init__(self, memmap):
+        self.memmap = memmap
+        self.filename = memmap.filename
+        self.copy = None
+
+def _mapped(memmap, mapped):
+    if memmap.filename not in mapped:
+        mapped[memmap.filename] = Mapped(memmap)
+    return mapped[memmap.filename]
+
+def snapshot(state, mapped=None):
+    # a copy that later rounds can't mutate, tensors are cloned off devices. An np.memmap
+    # attribute and tensors over it stand as a Mapped in mapped, {filename: Mapped}
+    mapped = {} if mapped is None else mapped
+    if isinstance(state, np.memmap):
+        return _mapped(state, mapped)
+    if isinstance(state, torch.Tensor):
+        return state.detach().cpu().clone()
+    if isinstance(state, dict):
+        return {key: snapshot(value, mapped) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value, mapped) for value in state)
+    if hasattr(state, "__dict__") and not callable(state):
+        memmaps = {value.ctypes.data: value for value in vars(state).values() if isinstance(value, np.memmap)}
+        _state = copy.copy(state)
+        _state.__dict__ = {key: _mapped(memmaps[value.data_ptr()], mapped)
+                           if isinstance(value, torch.Tensor) and value.data_ptr() in memmaps else snapshot(value, mapped)
+                           for key, value in vars(state).items()}
+        return _state
+    return copy.deepcopy(state)
+
+def restore(target, saved):
+    # saved into target in place, tensors are copied so memmaps and devices are kept
+    items = saved.items() if isinstance(saved, dict) else vars(saved).items()
+    for key, value in items:
+        current = target.get(key) if isinstance(target, dict) else getattr(target, key, None)
+        if isinstance(value, Mapped):
+            np.copyto(current.numpy() if isinstance(current, torch.Tensor) else current, np.load(value.copy, mmap_mode="r"))
+        elif isinstance(current, torch.Tensor) and isinstance(value, torch.Tensor) and current.shape == value.shape:
+            current.copy_(value)
+        elif isinstance(current, dict) or (hasattr(current, "__dict__") and not callable(current)):
+            restore(current, value)
+        elif isinstance(target, dict):
+            target[key] = value
+        else:
+            setattr(target, key, value)
+    return target
+
+class Checkpointer():
+    '''Checkpoints to path every `every` rounds, written on a background thread.
+
+    save() only snapshots in the calling thread and returns, the write goes
+    to path + ".tmp" and is renamed over path once complete, so a crash
+    leaves the previous checkpoint intact. Memory-mapped arrays of the state
+    are not copied in memory, their files are flushed and copied next to
+    path on the writer thread, so they must not change until wait().
+    '''
+    def __init__(self, path, every=1):
+        self.path = path
+        self.every = every
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.files = []
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def _write(self, checkpoint, mapped):
+        for _mapped in mapped.values():
+            _mapped.memmap.flush()
+            shutil.copyfile(_mapped.filename, _mapped.copy + ".tmp")
+            os.replace(_mapped.copy + ".tmp", _mapped.copy)
+            _mapped.memmap = None
+        with open(self.path + ".tmp", "wb") as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + ".tmp", self.path)
+
+        # the copies are per round, those of the previous checkpoint go once this one is in place
+        files = [_mapped.copy for _mapped in mapped.values()]
+        for file in self.files:
+            if file not in files and os.path.isfile(file):
+                os.remove(file)
+        self.files = files
+
+    def save(self, round, model, state=None):
+        if round % self.every != 0:
+            return
+        mapped = {}
+        checkpoint = {"round": round,
+                      "weights": sim.get_layout(model).flatten(model).cpu().clone(),
+                      "buffers": {name: buffer.detach().cpu().clone() for name, buffer in model.named_buffers()},
+                      "state": snapshot(state if state is not None else {}, mapped),
+                      "rng": {"torch": torch.get_rng_state(),
+                              "numpy": np.random.get_state(),
+                              "random": random.getstate()}}
+        if torch.cuda.is_available():
+            checkpoint["rng"]["cuda"] = torch.cuda.get_rng_state_all()
+
+        for _mapped in mapped.values():
+            _mapped.copy = "{}.{}.{}".format(self.path, round, os.path.basename(_mapped.filename))
+
+        # one write in flight, the previous one finishes first
+        self.wait()
+        self.future = self.executor.submit(self._write, checkpoint, mapped)
+
+    def load(self, model, state=None):
+        # model and state are restored in place, returns the round and the saved state
+        self.wait()
+        with open(self.path, "rb") as f:
+            checkpoint = pickle.load(f)
+        sim.get_layout(model).assign(model, checkpoint["weights"])
+        model.load_state_dict(checkpoint["buffers"], strict=False)
+        if state is not None:
+            restore(state, checkpoint["state"])
+        # array copies of this and any unfinished checkpoint, the next write removes those it doesn't use
+        self.files = glob.glob(glob.escape(self.path) + ".*.*")
+
+        torch.set_rng_state(checkpoint["rng"]["torch"])
+        np.random.set_state(checkpoint["rng"]["numpy"])
+        random.setstate(checkpoint["rng"]["random"])
+        if "cuda" in checkpoint["rng"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpoint["rng"]["cuda"])
+        return checkpoint["round"], checkpoint["state"]
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
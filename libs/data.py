@@ -24,16 +24,20 @@ from torchvision import datasets, transforms
 from torch.utils.data import DataLoader, Dataset
 
 class AGNEWs(Dataset):
-    def __init__(self, label_data_path, alphabet_path, l0 = 1014):
+    def __init__(self, label_data_path, alphabet_path, l0 = 1014, one_hot = True):
         """Create AG's News dataset object.
 
         Arguments:
             label_data_path: The path of label and data file in csv.
             l0: max length of a sample.
             alphabet_path: The path of alphabet json file.
+            one_hot: samples as 70 x l0 one-hot floats, else as the int8 index
+                rows, which nn.CharCNN takes as they are, or agnews_collate
+                expands per batch.
         """
         self.label_data_path = label_data_path
         self.l0 = l0
+        self.one_hot = one_hot
         # read alphabet
         self.loadAlphabet(alphabet_path)
         self.load(label_data_path)
@@ -44,7 +48,7 @@ class AGNEWs(Dataset):
 
 
     def __getitem__(self, idx):
-        X = self.oneHotEncode(idx)
+        X = self.oneHotEncode(idx) if self.one_hot else self.index[idx]
         y = self.y[idx]
         return X, y
 
@@ -53,6 +57,15 @@ class AGNEWs(Dataset):
             self.alphabet = ''.join(json.load(f))
 
     def load(self, label_data_path, lowercase = True):
+        # every text encoded once into a n x l0 int8 matrix of alphabet indices, reversed
+        # as oneHotEncode reads it, -1 for padding and unknown characters. Cached next to the csv
+        cache_path = os.path.splitext(label_data_path)[0] + "-" + str(self.l0)
+        if os.path.isfile(cache_path + "-y.npy"):
+            self.index = torch.from_numpy(np.load(cache_path + "-x.npy"))
+            self.y = torch.from_numpy(np.load(cache_path + "-y.npy"))
+            self.label = self.y.tolist()
+            return
+
         self.label = []
         self.data = []
         with open(label_data_path, 'r') as f:
@@ -67,15 +80,18 @@ class AGNEWs(Dataset):
 
         self.y = torch.LongTensor(self.label)
 
+        index = np.full((len(self.data), self.l0), -1, dtype=np.int8)
+        for idx, sequence in enumerate(self.data):
+            codes = [self.char2Index(char) for char in sequence[::-1][:self.l0]]
+            index[idx, :len(codes)] = codes
+        save_npy(cache_path + "-x.npy", index)
+        save_npy(cache_path + "-y.npy", self.y.numpy())
+        self.index = torch.from_numpy(index)
+
 
     def oneHotEncode(self, idx):
         # X = (batch, 70, sequence_length)
-        X = torch.zeros(len(self.alphabet), self.l0)
-        sequence = self.data[idx]
-        for index_char, char in enumerate(sequence[::-1]):
-            if self.char2Index(char)!=-1:
-                X[self.char2Index(char)][index_char] = 1.0
-        return X
+        return agnews_one_hot(self.index[idx][None], len(self.alphabet))[0]
 
     def char2Index(self, character):
         return self.alphabet.find(character)
@@ -86,6 +102,20 @@ class AGNEWs(Dataset):
         num_class = [self.label.count(c) for c in label_set]
         class_weight = [num_samples/float(self.label.count(c)) for c in label_set]    
         return class_weight, num_class
+
+def agnews_one_hot(index, alphabet_size = 70):
+    # n x l0 int8 indices to n x alphabet_size x l0 one-hot floats, -1 stays all zeros
+    index = index.long()
+    index = torch.where(index < 0, torch.full_like(index, alphabet_size), index)
+    X = torch.zeros(index.shape[0], alphabet_size + 1, index.shape[1])
+    X.scatter_(1, index[:, None, :], 1.0)
+    return X[:, :alphabet_size]
+
+def agnews_collate(batch):
+    # collate_fn for AGNEWs(one_hot = False), the batch is one-hot encoded at once
+    index = torch.stack([X for X, _ in batch])
+    y = torch.stack([torch.as_tensor(y) for _, y in batch])
+    return agnews_one_hot(index), y
     
 class CelebaDataset(Dataset):
     """Custom Dataset for loading CelebA face images"""
@@ -100,7 +130,7 @@ class CelebaDataset(Dataset):
         self.transform = transform
 
     def __getitem__(self, index):
-        img = Image.open(os.path.join(self.img_dir,
+        img = PIL.Image.open(os.path.join(self.img_dir,
                                       self.img_names[index]))
         
         if self.transform is not None:
@@ -124,7 +154,105 @@ class MedNISTDataset(torch.utils.data.Dataset):
     def __getitem__(self, index):
         return self.transforms(self.image_files[index]), self.labels[index]
 
-def load_dataset(dataset, only_to_tensor = False):
+class MemoryDataset(Dataset):
+    """Whole dataset as one uint8 N x C x H x W tensor, normalized per batch.
+
+    Samples come out as the torchvision transforms of load_dataset would give
+    them, augment being the CIFAR10 random crop (padding 4) and flip, applied
+    by batch_transform to a whole batch at once.
+    """
+
+    def __init__(self, x, targets, mean, std, augment=False):
+        self.x = x
+        self.targets = targets
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        return self.batch_transform(self.take(torch.tensor([index])))[0], self.targets[index]
+
+    def take(self, indices):
+        return self.x.index_select(0, indices)
+
+    def batch_transform(self, x):
+        x = x.float().div_(255)
+        if self.augment:
+            n, c, h, w = x.shape
+            padded = torch.nn.functional.pad(x, (4, 4, 4, 4))
+            rows = torch.randint(0, 9, (n, 1)) + torch.arange(h)
+            cols = torch.randint(0, 9, (n, 1)) + torch.arange(w)
+            x = padded[torch.arange(n)[:, None, None, None], torch.arange(c)[None, :, None, None],
+                       rows[:, None, :, None], cols[:, None, None, :]]
+            flip = torch.rand(n) < 0.5
+            x[flip] = x[flip].flip(3)
+        return x.sub_(self.mean).div_(self.std)
+
+class BatchLoader():
+    """DataLoader over the indices of a MemoryDataset, without per sample work.
+
+    Every epoch shuffles the index array and slices whole batches with
+    index_select. dataset is the Subset the loader covers, as for a DataLoader,
+    and generator, if set, draws the shuffles.
+    """
+
+    def __init__(self, data, indices, batch_size, shuffle=True, generator=None):
+        self.data = data
+        self.generator = generator
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dataset = torch.utils.data.Subset(data, self.indices)
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices[torch.randperm(len(self.indices), generator=self.generator)] if self.shuffle else self.indices
+        for start_index in range(0, len(indices), self.batch_size):
+            batch = indices[start_index:start_index + self.batch_size]
+            yield self.data.batch_transform(self.data.take(batch)), self.data.targets.index_select(0, batch)
+
+class MemmapDataset(MemoryDataset):
+    """MemoryDataset over a memory-mapped uint8 image cache, see cache_images.
+
+    Batches are scaled to [0, 1], per image min-max with scale_intensity
+    (MONAI ScaleIntensity), and with augment get the MedNIST training
+    augmentations as one batched affine warp: rotation up to 15 degrees,
+    zoom 0.9 to 1.1 and a horizontal flip, each with p 0.5. MONAI's
+    LoadImage reads images transposed, W x H, so its RandFlip(spatial_axis=0)
+    flips along the width, the last axis of the C x H x W cache.
+    """
+
+    def __init__(self, x, targets, scale_intensity=False, augment=False):
+        super().__init__(x, targets, (0.0,), (1.0,), augment)
+        self.scale_intensity = scale_intensity
+
+    def take(self, indices):
+        return torch.from_numpy(self.x[np.asarray(indices)])
+
+    def batch_transform(self, x):
+        x = x.float().div_(255)
+        if self.scale_intensity:
+            low = x.amin(dim=(1, 2, 3), keepdim=True)
+            high = x.amax(dim=(1, 2, 3), keepdim=True)
+            x = (x - low) / (high - low).clamp_(min=1e-8)
+        if self.augment:
+            n = x.shape[0]
+            angle = torch.where(torch.rand(n) < 0.5, (torch.rand(n) * 2 - 1) * np.pi / 12, torch.zeros(n))
+            zoom = torch.where(torch.rand(n) < 0.5, 0.9 + torch.rand(n) * 0.2, torch.ones(n))
+            cos, sin, zeros = torch.cos(angle) / zoom, torch.sin(angle) / zoom, torch.zeros(n)
+            theta = torch.stack([torch.stack([cos, -sin, zeros], 1), torch.stack([sin, cos, zeros], 1)], 1)
+            grid = torch.nn.functional.affine_grid(theta, list(x.shape), align_corners=False)
+            x = torch.nn.functional.grid_sample(x, grid, padding_mode="border", align_corners=False)
+            flip = torch.rand(n) < 0.5
+            x[flip] = x[flip].flip(3)
+        return x
+
+def load_dataset(dataset, only_to_tensor = False, cached = False):
     if only_to_tensor:
         transform=transforms.ToTensor()
     elif dataset.upper() == "MNIST" or dataset.upper() == "FMNIST":
@@ -166,7 +294,7 @@ def load_dataset(dataset, only_to_tensor = False):
         image_files = [
             [
                 os.path.join(data_dir, class_names[i], x)
-                for x in os.listdir(os.path.join(data_dir, class_names[i]))
+                for x in sorted(os.listdir(os.path.join(data_dir, class_names[i])))
             ]
             for i in range(num_class)
         ]
@@ -219,6 +347,13 @@ def load_dataset(dataset, only_to_tensor = False):
         train_data = MedNISTDataset(train_x, train_y, train_transforms)
         valid_data = MedNISTDataset(val_x, val_y, val_transforms)
         test_data = MedNISTDataset(test_x, test_y, val_transforms)
+
+        if cached:
+            # the same splits over one decoded copy of every image, augmented per batch
+            x, y = cache_images(image_files_list, image_class, datadir + '/tensors/mednist', "L")
+            train_data = torch.utils.data.Subset(MemmapDataset(x, y, scale_intensity=True, augment=True), train_indices)
+            valid_data = torch.utils.data.Subset(MemmapDataset(x, y, scale_intensity=True), val_indices)
+            test_data = torch.utils.data.Subset(MemmapDataset(x, y, scale_intensity=True), test_indices)
         
     if dataset.upper() == "CELEBA":
         # 1. Download this file into dataset_directory:
@@ -233,22 +368,24 @@ def load_dataset(dataset, only_to_tensor = False):
         #           +- 000003.jpg
         #           +- ...
         
-        df1 = pd.read_csv(datadir + '/celeba/list_attr_celeba.txt', sep="\s+", skiprows=1, usecols=['Male'])
+        # partition csvs, written once
+        if not all(os.path.isfile(datadir + '/celeba/celeba-gender-' + split + '.csv') for split in ["train", "valid", "test"]):
+            df1 = pd.read_csv(datadir + '/celeba/list_attr_celeba.txt', sep="\s+", skiprows=1, usecols=['Male'])
 
-        # Make 0 (female) & 1 (male) labels instead of -1 & 1
-        df1.loc[df1['Male'] == -1, 'Male'] = 0
-        
-        df2 = pd.read_csv(datadir + '/celeba/list_eval_partition.txt', sep="\s+", skiprows=0, header=None)
-        df2.columns = ['Filename', 'Partition']
-        df2 = df2.set_index('Filename')
-        
-        df3 = df1.merge(df2, left_index=True, right_index=True)
-        df3.to_csv(datadir + '/celeba/celeba-gender-partitions.csv')
-        df4 = pd.read_csv(datadir + '/celeba/celeba-gender-partitions.csv', index_col=0)
-        
-        df4.loc[df4['Partition'] == 0].to_csv(datadir + '/celeba/celeba-gender-train.csv')
-        df4.loc[df4['Partition'] == 1].to_csv(datadir + '/celeba/celeba-gender-valid.csv')
-        df4.loc[df4['Partition'] == 2].to_csv(datadir + '/celeba/celeba-gender-test.csv')
+            # Make 0 (female) & 1 (male) labels instead of -1 & 1
+            df1.loc[df1['Male'] == -1, 'Male'] = 0
+
+            df2 = pd.read_csv(datadir + '/celeba/list_eval_partition.txt', sep="\s+", skiprows=0, header=None)
+            df2.columns = ['Filename', 'Partition']
+            df2 = df2.set_index('Filename')
+
+            df3 = df1.merge(df2, left_index=True, right_index=True)
+            df3.to_csv(datadir + '/celeba/celeba-gender-partitions.csv')
+            df4 = pd.read_csv(datadir + '/celeba/celeba-gender-partitions.csv', index_col=0)
+
+            df4.loc[df4['Partition'] == 0].to_csv(datadir + '/celeba/celeba-gender-train.csv')
+            df4.loc[df4['Partition'] == 1].to_csv(datadir + '/celeba/celeba-gender-valid.csv')
+            df4.loc[df4['Partition'] == 2].to_csv(datadir + '/celeba/celeba-gender-test.csv')
         
         train_data = CelebaDataset(csv_path=datadir + '/celeba/celeba-gender-train.csv',
                               img_dir=datadir + '/celeba/img_align_celeba/',
@@ -261,6 +398,16 @@ def load_dataset(dataset, only_to_tensor = False):
         test_data = CelebaDataset(csv_path=datadir + '/celeba/celeba-gender-test.csv',
                                      img_dir=datadir + '/celeba/img_align_celeba/',
                                      transform=transform)
+
+        if cached:
+            # ToTensor of every split from one decoded copy of its images
+            splits = []
+            for split in [train_data, valid_data, test_data]:
+                name = os.path.splitext(os.path.basename(split.csv_path))[0]
+                x, y = cache_images([os.path.join(split.img_dir, img_name) for img_name in split.img_names], split.y,
+                                    datadir + '/tensors/' + name, "RGB")
+                splits.append(MemmapDataset(x, y))
+            train_data, valid_data, test_data = splits
         
     if dataset.upper() == "CIFAR10":
         transform_train = transforms.Compose([
@@ -307,6 +454,33 @@ def load_dataset(dataset, only_to_tensor = False):
     return train_data, test_data
 
 
+def save_npy(path, arr):
+    # runs of a sweep may share the caches, a file appears whole or not at all
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+def cache_images(files, labels, path, mode):
+    # every image decoded once into a n x C x H x W uint8 .npy, memory-mapped from then
+    # on, with the labels. The images share one shape, the labels are written last
+    if not os.path.isfile(path + '-y.npy'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        first = np.asarray(PIL.Image.open(files[0]).convert(mode))
+        channels = 1 if first.ndim == 2 else first.shape[2]
+        tmp_path = path + '-x.npy.' + str(os.getpid()) + '.tmp'
+        x = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                      shape=(len(files), channels) + first.shape[:2])
+        for index, file in enumerate(files):
+            img = np.asarray(PIL.Image.open(file).convert(mode))
+            x[index] = img[None] if img.ndim == 2 else img.transpose(2, 0, 1)
+        x.flush()
+        del x
+        os.replace(tmp_path, path + '-x.npy')
+        save_npy(path + '-y.npy', np.asarray(labels, dtype=np.int64))
+
+    return np.load(path + '-x.npy', mmap_mode="r"), torch.from_numpy(np.load(path + '-y.npy'))
+
 def random_split(data, ratio):
     split_arr = [int(len(data) * (1-ratio)), int(len(data) * ratio)]
     rem_data = len(data) - sum(split_arr)
@@ -326,6 +500,83 @@ def split_data(train_data, clients):
 
     return clients_data
 
+def get_targets(dataset):
+    # labels of every sample from the dataset's label array, without loading samples
+    if isinstance(dataset, torch.utils.data.Subset):
+        return get_targets(dataset.dataset)[np.asarray(dataset.indices)]
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        return np.asarray(dataset.tensors[-1]).reshape(len(dataset), -1)[:, 0].astype(np.int64)
+    for attr in ["targets", "y", "labels"]:
+        if hasattr(dataset, attr):
+            return np.asarray(getattr(dataset, attr)).astype(np.int64)
+    return np.asarray([int(target) for _, target in dataset], dtype=np.int64)
+
+def partition_indices(targets, num_clients, method="iid", alpha=0.5, shards=2, seed=None, min_size=10):
+    # order of the sample indices grouped by client, and num_clients + 1 offsets into it
+    rng = np.random.default_rng(seed)
+    n = len(targets)
+    if n < num_clients:
+        raise ValueError("{} samples can not be split over {} clients".format(n, num_clients))
+    if method == "iid":
+        order = rng.permutation(n)
+        offsets = np.arange(num_clients + 1) * (n // num_clients)
+        offsets[-1] = n
+        return order, offsets
+
+    if method == "shard":
+        # label sorted samples cut into num_clients * shards shards, shards random shards per client
+        perm = rng.permutation(n)
+        by_label = perm[np.argsort(targets[perm], kind="stable")]
+        cuts = np.linspace(0, n, num_clients * shards + 1).astype(np.int64)
+        shard_of = np.repeat(rng.permutation(num_clients * shards), np.diff(cuts))
+        client_of = np.empty(n, dtype=np.int64)
+        client_of[by_label] = shard_of // shards
+    elif method == "dirichlet":
+        # every label's samples spread over the clients by proportions drawn from Dir(alpha),
+        # drawn again until every client holds at least min_size samples
+        min_size = min(min_size, n // num_clients)
+        client_of = np.empty(n, dtype=np.int64)
+        for _ in range(1000):
+            for label in np.unique(targets):
+                indices = rng.permutation(np.flatnonzero(targets == label))
+                counts = rng.multinomial(len(indices), rng.dirichlet(np.full(num_clients, alpha)))
+                client_of[indices] = np.repeat(np.arange(num_clients), counts)
+            if np.bincount(client_of, minlength=num_clients).min() >= max(min_size, 1):
+                break
+        else:
+            raise ValueError("No Dir({}) split with {} samples per client in 1000 draws, use a larger alpha or "
+                             "smaller min_size".format(alpha, min_size))
+    else:
+        raise ValueError("Unknown partition method {}".format(method))
+
+    sizes = np.bincount(client_of, minlength=num_clients)
+    if sizes.min() == 0:
+        raise ValueError("Clients {} got no samples".format(np.flatnonzero(sizes == 0).tolist()))
+
+    order = rng.permutation(n)
+    order = order[np.argsort(client_of[order], kind="stable")]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    return order, offsets
+
+def partition_data(train_data, clients, method="iid", alpha=0.5, shards=2, seed=None, name=None, min_size=10):
+    # split_data with label skew, {client: Subset}. With a dataset name the index
+    # arrays are cached under data/partitions and reloaded by later runs
+    param = "{}_{}".format(alpha, min_size) if method == "dirichlet" else shards if method == "shard" else ""
+    partdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/../data/partitions'
+    path = os.path.join(partdir, "-".join(str(key) for key in [name, len(train_data), method, param, seed, len(clients)]))
+
+    if name is not None and os.path.isfile(path + "/offsets.npy"):
+        order, offsets = np.load(path + "/order.npy", mmap_mode="r"), np.load(path + "/offsets.npy")
+    else:
+        order, offsets = partition_indices(get_targets(train_data), len(clients), method, alpha, shards, seed, min_size)
+        if name is not None:
+            os.makedirs(path, exist_ok=True)
+            save_npy(path + "/order.npy", order)
+            save_npy(path + "/offsets.npy", offsets)
+
+    return {client: torch.utils.data.Subset(train_data, order[offsets[index]:offsets[index + 1]])
+            for index, client in enumerate(clients)}
+
 
 def load_client_data(clients_data, batch_size, test_ratio=None, **kwargs):
     train_loaders = {}
@@ -347,4 +598,53 @@ def load_client_data(clients_data, batch_size, test_ratio=None, **kwargs):
                 train_loaders[client] = torch.utils.data.DataLoader(train_test[0], batch_size=len(train_test[0]), shuffle=True, **kwargs)
                 test_loaders[client] = torch.utils.data.DataLoader(train_test[1], batch_size=len(train_test[1]), shuffle=True, **kwargs)
 
-    return train_loaders, test_loaders
\ No newline at end of file
+    return train_loaders, test_loaders
+
+def load_tensor_dataset(dataset):
+    # load_dataset as MemoryDatasets, for MNIST, FMNIST and CIFAR10. The raw uint8
+    # arrays are cached under data/tensors, so images are decoded once
+    datadir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/../data'
+    sources = {"MNIST": (datasets.MNIST, (0.1307,), (0.3081,)),
+               "FMNIST": (datasets.FashionMNIST, (0.1307,), (0.3081,)),
+               "CIFAR10": (datasets.CIFAR10, (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))}
+    if dataset.upper() not in sources:
+        raise ValueError("No in memory mode for {}".format(dataset))
+    source, mean, std = sources[dataset.upper()]
+
+    os.makedirs(datadir + '/tensors', exist_ok=True)
+    splits = []
+    for split in ["train", "test"]:
+        path = datadir + '/tensors/' + dataset.lower() + '-' + split
+        if not os.path.isfile(path + '-y.npy'):
+            raw = source(root=datadir, train=split == "train", download=True)
+            x = np.asarray(raw.data)
+            # N x H x W for MNIST, N x H x W x C for CIFAR10
+            x = x[:, None] if x.ndim == 3 else x.transpose(0, 3, 1, 2)
+            save_npy(path + '-x.npy', np.ascontiguousarray(x, dtype=np.uint8))
+            save_npy(path + '-y.npy', np.asarray(raw.targets, dtype=np.int64))
+
+        splits.append(MemoryDataset(torch.from_numpy(np.load(path + '-x.npy')), torch.from_numpy(np.load(path + '-y.npy')),
+                                    mean, std, augment=dataset.upper() == "CIFAR10" and split == "train"))
+    return splits[0], splits[1]
+
+def tensor_indices(data):
+    # the MemoryDataset under data and its indices into it, through nested Subsets, or None
+    indices = None
+    while isinstance(data, torch.utils.data.Subset):
+        indices = np.asarray(data.indices) if indices is None else np.asarray(data.indices)[indices]
+        data = data.dataset
+    if not isinstance(data, MemoryDataset):
+        return None
+    return data, np.arange(len(data)) if indices is None else indices
+
+def load_client_batches(clients_data, batch_size, **kwargs):
+    # load_client_data with BatchLoaders for shards of a MemoryDataset, poisoned
+    # shards that are plain lists of samples still get a DataLoader
+    train_loaders = {}
+    for client, data in clients_data.items():
+        memory = tensor_indices(data)
+        if memory is not None:
+            train_loaders[client] = BatchLoader(memory[0], memory[1], batch_size)
+        else:
+            train_loaders[client] = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=True, **kwargs)
+    return train_loaders
@@ -1,4 +1,4 @@
-import copy
+import asyncio, copy, random
 from typing import Any
 from typing import Dict
 
@@ -8,7 +8,7 @@ from torch import optim
 
 import os, sys, time
 sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../")))
-from libs import agg
+from libs import agg, log, sim, stacked
 
 def audit_attack(target, pred, flip_labels, attack_dict):
     if flip_labels is not None and len(flip_labels) > 0:
@@ -66,8 +66,9 @@ def client_binary(_model, data_loader, learning_rate, decay, epochs, device):
         loss["Epoch " + str(epoch + 1)] = _loss.item()
     return model, loss
 
-def client_update(_model, data_loader, learning_rate, decay, epochs, device):
-    model = copy.deepcopy(_model)
+def client_update(_model, data_loader, learning_rate, decay, epochs, device, inplace=False):
+    # inplace trains _model itself, e.g. a resident working model
+    model = _model if inplace else copy.deepcopy(_model)
     loss = {}
     optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=decay)
     model.train()
@@ -166,37 +167,186 @@ def evaluate_binary(model, test_loader, device, flip_labels = None):
 def federated_avg(models: Dict[Any, torch.nn.Module],
                   base_model: torch.nn.Module = None,
                   rule: agg.Rule = agg.Rule.FedAvg, **kwargs) -> torch.nn.Module:
-    if len(models) > 1:
-        if rule is agg.Rule.FedAvg:
-            model = agg.FedAvg(base_model, models)
-        if rule is agg.Rule.FedVal:
-            model = agg.FedVal(base_model, models, **kwargs)
-        if rule is agg.Rule.FoolsGold:
-            model = agg.FoolsGold(base_model, models, **kwargs)            
-        if rule is agg.Rule.FLTrust:
-            model = agg.FLTrust(base_model, models, **kwargs)
-        if rule is agg.Rule.FLTC:
-            model = agg.FLTC(base_model, models, **kwargs)
-        if rule is agg.Rule.Krum:
-            model = agg.Krum(base_model, models, **kwargs)
-        if rule is agg.Rule.M_Krum:
-            model = agg.M_Krum(base_model, models, **kwargs)
-        if rule is agg.Rule.Median:
-            model = agg.Median(base_model, models, **kwargs)
-        if rule is agg.Rule.T_Mean:
-            model = agg.T_Mean(base_model, models, **kwargs)
-        if rule is agg.Rule.DnC:
-            model = agg.DnC(base_model, models, **kwargs)            
+    # models may also be an agg.UpdateMatrix that is already flat, e.g. from an agg.UpdateStore
+    if isinstance(models, agg.UpdateMatrix):
+        model = agg.aggregate(models, base_model, rule, **kwargs)
     else:
-        model = copy.deepcopy(list(models.values())[0])
+        # one n x d matrix of client updates per round, shared by every rule, a single
+        # update too, so it is applied to base_model rather than taken as the model
+        model = agg.aggregate(agg.UpdateMatrix(models), base_model, rule, **kwargs)
     return model
 
+def stream_updates(loop, tasks, aggregator):
+    # fold each client's update into the aggregator as soon as its task is done, tasks is {client: awaitable}
+    async def fold(client, task):
+        aggregator.add(client, await task)
+
+    loop.run_until_complete(asyncio.gather(*[fold(client, task) for client, task in tasks.items()]))
+    return aggregator
+
 def train_model(_model, train_loader, lr, wd, r, device):
     model, loss = client_update(_model, train_loader, lr, wd, r, device)
     model_update = agg.sub_model(_model, model)
     return model_update, model, loss
 
+def train_cohort(_model, train_loaders, lr, wd, r, device, chunk_size=None):
+    # train_model for a whole cohort of small models in one vmapped pass, returns {client: model_update}, {client: loss}
+    arr, losses = stacked.train(copy.deepcopy(_model).to(device), train_loaders, lr, wd, r, device, chunk_size)
+    updates = sim.get_layout(_model).flatten(_model).to(arr.device) - arr
+    model_updates = {client: sim.get_arr_net(_model, updates[index].cpu(), None)
+                     for index, client in enumerate(train_loaders.keys())}
+    return model_updates, losses
+
 def train_binary(_model, train_loader, lr, wd, r, device):
     model, loss = client_binary(_model, train_loader, lr, wd, r, device)
     model_update = agg.sub_model(_model, model)
-    return model_update, model, loss
\ No newline at end of file
+    return model_update, model, loss
+
+class Scheduler():
+    '''Rounds that end at a deadline, once at least quorum clients reported.
+
+    run(tasks) takes {client: awaitable} on loop and returns the updates that
+    arrived, for fl.federated_avg, with their staleness in rounds. Late
+    clients are cancelled, or with carry=True kept running into the next
+    rounds, where their update comes back tagged with the rounds it missed.
+    Clients in pending are still busy and should not be scheduled again.
+    latency keeps the seconds each client took on its last update, for a
+    client that missed the round at least the time the round waited for it.
+    '''
+    def __init__(self, loop, deadline, quorum=1, carry=False):
+        self.loop = loop
+        self.deadline = deadline
+        self.quorum = quorum
+        self.carry = carry
+        self.round = 0
+        self.pending = {}
+        self.latency = {}
+
+    async def _timed(self, client, task):
+        start_time = time.time()
+        update = await task
+        self.latency[client] = time.time() - start_time
+        return update
+
+    async def _wait(self, futures):
+        if not futures:
+            return set()
+        done, pending = await asyncio.wait(futures, timeout=self.deadline)
+        while len(done) < self.quorum and pending:
+            _done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            done |= _done
+        return done
+
+    def run(self, tasks):
+        started = {client: (asyncio.ensure_future(self._timed(client, task), loop=self.loop), self.round)
+                   for client, task in tasks.items()}
+        started.update(self.pending)
+        clients = {future: client for client, (future, _) in started.items()}
+
+        start_time = time.time()
+        done = self.loop.run_until_complete(self._wait(list(clients.keys())))
+        waited = max(self.deadline, time.time() - start_time)
+
+        updates, staleness = {}, {}
+        for future in done:
+            client = clients[future]
+            if future.exception() is not None:
+                log.error("Client {} failed in round {}: {}".format(client, self.round, future.exception()))
+                continue
+            updates[client] = future.result()
+            staleness[client] = self.round - started[client][1]
+
+        self.pending = {client: started[client] for future, client in clients.items() if future not in done}
+        # stragglers rank behind the clients that made it, until they report
+        for client in self.pending:
+            self.latency[client] = max(self.latency.get(client, 0.0), waited)
+        if not self.carry:
+            # an executor thread already running finishes in the background, its result is dropped
+            for future, _ in self.pending.values():
+                future.cancel()
+            self.pending = {}
+
+        self.round += 1
+        return updates, staleness
+
+    def ranked(self, clients):
+        # fastest first, clients without a recorded latency first of all
+        return sorted(clients, key=lambda client: self.latency.get(client, 0.0))
+
+class Buffered():
+    '''FedBuff style asynchronous training on loop.
+
+    concurrency clients at a time pull the latest global model and its
+    version, train with train_func and push their update. Every buffer_size
+    updates the server scales each by (1 + staleness) ** -staleness_exponent
+    and applies rule to the scaled updates with agg.aggregate, which makes
+    the next version. on_version(global_model, version) is called for every
+    version from 0 on, e.g. to test it, or with a workers.ClientTrainer's
+    begin_round, whose train_func then runs clients on its process pool.
+    '''
+    def __init__(self, loop, train_func, rule=agg.Rule.FedAvg, buffer_size=10, concurrency=4,
+                 staleness_exponent=0.5, seed=None, **kwargs):
+        self.loop = loop
+        self.train_func = train_func
+        self.rule = rule
+        self.buffer_size = buffer_size
+        self.concurrency = concurrency
+        self.staleness_exponent = staleness_exponent
+        self.random = random.Random(seed)
+        self.kwargs = kwargs
+
+    def push(self, client, update, version):
+        staleness = self.version - version
+        self.buffer.append((update, staleness))
+        self.staleness.append(staleness)
+        self.updates += 1
+        if len(self.buffer) < self.buffer_size:
+            return
+
+        um = agg.UpdateMatrix({index: update for index, (update, _) in enumerate(self.buffer)})
+        weights = torch.tensor([(1 + staleness) ** -self.staleness_exponent for _, staleness in self.buffer])
+        um.arr *= weights[:, None]
+        self.global_model = agg.aggregate(um, self.global_model, self.rule, **self.kwargs)
+        self.version += 1
+        self.buffer = []
+        if self.on_version is not None:
+            self.on_version(self.global_model, self.version)
+
+    async def _client_loop(self, train_loaders, lr, wd, local_rounds, device, versions):
+        while self.version < versions:
+            client = self.random.choice([client for client in train_loaders if client not in self.busy])
+            self.busy.add(client)
+            model, version = self.global_model, self.version
+            try:
+                model_update, _, loss = await self.loop.run_in_executor(None, self.train_func, model, train_loaders[client],
+                                                                        lr, wd, local_rounds, device)
+            finally:
+                self.busy.discard(client)
+            if self.version < versions:
+                self.push(client, model_update, version)
+
+    def run(self, global_model, train_loaders, lr, wd, local_rounds, device, versions, on_version=None):
+        # trains until the global model reaches `versions`, returns it
+        self.global_model, self.version = global_model, 0
+        self.on_version = on_version
+        self.buffer, self.busy, self.staleness = [], set(), []
+        self.updates, self.start_time = 0, time.time()
+        if on_version is not None:
+            on_version(global_model, 0)
+
+        concurrency = min(self.concurrency, len(train_loaders))
+        self.loop.run_until_complete(asyncio.gather(*[self._client_loop(train_loaders, lr, wd, local_rounds, device, versions)
+                                                      for _ in range(concurrency)]))
+        self.elapsed = time.time() - self.start_time
+        return self.global_model
+
+    def stats(self):
+        # updates/sec and the staleness distribution {staleness: count} of the last run
+        distribution = {}
+        for staleness in self.staleness:
+            distribution[staleness] = distribution.get(staleness, 0) + 1
+        return {"updates": self.updates,
+                "versions": self.version,
+                "updates_per_second": self.updates / self.elapsed if self.elapsed > 0 else 0.0,
+                "mean_staleness": sum(self.staleness) / len(self.staleness) if self.staleness else 0.0,
+                "staleness": dict(sorted(distribution.items()))}
@@ -57,8 +57,27 @@ class  CharCNN(nn.Module):
         self.fc3 = nn.Linear(256, 4)
         self.log_softmax = nn.LogSoftmax()
 
+    def embed_conv1(self, x):
+        # conv1 on one-hot inputs, from the n x l0 character indices (-1 for none) they encode:
+        # out[:, :, t] = bias + sum_k weight[:, x[t + k], k], a gather of kernel columns per tap
+        conv = self.conv1[0]
+        kernel_size = conv.kernel_size[0]
+        # l0 x in_channels x out_channels per tap, a zero row at in_channels for -1
+        table = F.pad(conv.weight.permute(2, 1, 0), (0, 0, 0, 1))
+        x = x.long()
+        x = torch.where(x < 0, torch.full_like(x, conv.in_channels), x)
+        length = x.shape[1] - kernel_size + 1
+        out = conv.bias
+        for k in range(kernel_size):
+            out = out + F.embedding(x[:, k:k + length], table[k])
+        return out.permute(0, 2, 1)
+
     def forward(self, x):
-        x = self.conv1(x)
+        # x is either n x 70 x l0 one-hot floats or n x l0 integer character indices, see data.AGNEWs
+        if x.dtype.is_floating_point:
+            x = self.conv1(x)
+        else:
+            x = self.conv1[1:](self.embed_conv1(x))
         x = self.conv2(x)
         x = self.conv3(x)
         x = self.conv4(x)
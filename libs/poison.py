@@ -329,6 +329,9 @@ def layer_replacement_attack(model_to_attack, model_to_reference, layers):
     model.load_state_dict(params1, strict=False)
     return model
 
+# z_max of "A Little Is Enough" by the number of attackers, 50 clients
+lie_z_values = {3:0.69847, 5:0.7054, 8:0.71904, 10:0.72575, 12:0.73891}
+
 def lie_attack(models, n_attackers, kn = Knowledge.PN):
     model_list = list(models.values())
     model_keys = list(models.keys())
@@ -349,10 +352,7 @@ def lie_attack(models, n_attackers, kn = Knowledge.PN):
     avg = np.array(v).mean(0)
     std = torch.std(torch.tensor(v), 0)
 
-    z_values={3:0.69847, 5:0.7054, 8:0.71904, 10:0.72575, 12:0.73891}
-    #z_values={3:0.69847, 5:0.7054, 8:0.71904, 10:0.72575, 12:0.73891}
-    
-    mal_update = avg + z_values[n_attackers] * std.numpy()
+    mal_update = avg + lie_z_values[n_attackers] * std.numpy()
     
     for index in range(n_attackers):
         models[model_keys[index]] = sim.get_arr_net(dummy_model, mal_update, d_shape)
@@ -0,0 +1,69 @@
+import numpy as np
+import torch
+
+# A client is an id, its shard of dataset indices and a small state record.
+# Loaders are only built for the clients scheduled in a round and the
+# models come from the global model, so memory follows the clients per round
+# rather than the population.
+
+class Client():
+    __slots__ = ("id", "indices", "state")
+
+    def __init__(self, id, indices, state):
+        self.id = id
+        self.indices = indices
+        self.state = state
+
+    def loader(self, dataset, batch_size, **kwargs):
+        return torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, self.indices),
+                                           batch_size=batch_size, shuffle=True, **kwargs)
+
+class Registry():
+    '''Client population over one dataset.
+
+    shards maps client -> dataset indices, by default an equal random split
+    as data.split_data makes, the remainder going to the last client. The
+    shards live in one index array with offsets, a client's state dict is
+    only created once the client is looked up. loaders() builds loaders for
+    the clients of a round with loader_func(clients_data, batch_size,
+    **kwargs), e.g. data.load_client_batches, by default DataLoaders.
+    '''
+    def __init__(self, dataset, clients, shards=None, seed=None, loader_func=None):
+        self.dataset = dataset
+        self.loader_func = loader_func
+        self.clients = list(clients)
+        self.index = {client: index for index, client in enumerate(self.clients)}
+        n = len(self.clients)
+
+        if shards is None:
+            self.order = np.random.default_rng(seed).permutation(len(dataset))
+            self.offsets = np.arange(n + 1) * (len(dataset) // n)
+            self.offsets[-1] = len(dataset)
+        else:
+            self.order = np.concatenate([np.asarray(shards[client], dtype=np.int64) for client in self.clients])
+            self.offsets = np.concatenate([[0], np.cumsum([len(shards[client]) for client in self.clients])])
+        self.states = {}
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def __getitem__(self, client):
+        index = self.index[client]
+        return Client(client, self.order[self.offsets[index]:self.offsets[index + 1]],
+                      self.states.setdefault(client, {}))
+
+    def sample(self, fraction, rng=None):
+        # max(C * K, 1) clients without replacement, in population order. rng is a
+        # np.random.Generator carried across rounds, or a seed such as [seed, round]
+        m = max(1, int(round(fraction * len(self.clients))))
+        chosen = np.sort(np.random.default_rng(rng).choice(len(self.clients), m, replace=False))
+        return [self.clients[index] for index in chosen]
+
+    def loaders(self, clients, batch_size, **kwargs):
+        if self.loader_func is not None:
+            return self.loader_func({client: torch.utils.data.Subset(self.dataset, self[client].indices) for client in clients},
+                                    batch_size, **kwargs)
+        return {client: self[client].loader(self.dataset, batch_size, **kwargs) for client in clients}
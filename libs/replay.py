@@ -0,0 +1,76 @@
+import hashlib, os
+import numpy as np
+import torch
+from threading import Lock
+
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../")))
+from libs import sim
+
+# Honest client updates recorded on disk and replayed by later runs, keyed by
+# (split, seed, client, round, global model hash). split names everything
+# else that decides what a client trains on and how, e.g. dataset, clients,
+# model and hyperparameters. Within a sweep over agg.Rule and the model
+# poisoning attacks of libs/poison.py, every run with the same seed shares
+# the same round 0, and rounds after it as long as the global models agree.
+
+def model_hash(model):
+    digest = hashlib.sha1(sim.get_layout(model).flatten(model).cpu().numpy().tobytes())
+    for name, buffer in model.named_buffers():
+        digest.update(name.encode())
+        digest.update(buffer.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+class UpdateCache():
+    '''Flat float32 updates, one .npz per key under root/split/seed/round/hash.
+
+    begin_round hashes the global model once per round. get returns the
+    recorded model_update of a client or None, put records one. A replayed
+    update skips the RNG draws its training would have made. stats()
+    reports hits, misses and the hit rate.
+    '''
+    def __init__(self, root, split, seed, model):
+        self.root = os.path.join(root, split, str(seed))
+        self.template = model
+        self.lock = Lock()
+        self.hits, self.misses = 0, 0
+        self.dir = None
+
+    def begin_round(self, round, global_model):
+        self.dir = os.path.join(self.root, str(round), model_hash(global_model))
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, client):
+        return os.path.join(self.dir, str(client) + ".npz")
+
+    def get(self, client):
+        path = self.path(client)
+        if not os.path.isfile(path):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with np.load(path) as saved:
+            model_update = sim.get_arr_net(self.template, saved["update"], None)
+            buffers = {name[len("buffer."):]: torch.from_numpy(saved[name]) for name in saved.files if name.startswith("buffer.")}
+        model_update.load_state_dict(buffers, strict=False)
+        with self.lock:
+            self.hits += 1
+        return model_update
+
+    def put(self, client, model_update):
+        arrs = {"update": sim.get_layout(model_update).flatten(model_update).cpu().numpy()}
+        for name, buffer in model_update.named_buffers():
+            arrs["buffer." + name] = buffer.detach().cpu().numpy()
+
+        # runs of a sweep may share the cache, the record appears whole or not at all
+        path = self.path(client)
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrs)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
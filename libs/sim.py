@@ -2,6 +2,51 @@ import copy, cmath, torch
 import numpy as nd
 #from mxnet import nd as mnd
 
+class Layout():
+    '''Flat layout of a model's parameters, in `model.parameters()` order.
+
+    Built once per architecture (see get_layout), so flattening a model is a
+    single copy of every parameter into one float32 vector, and a flat vector
+    is written back into an existing model in place.
+    '''
+    def __init__(self, model):
+        self.names, self.shapes, self.slices = [], [], []
+        start_index = 0
+        for name, param in model.named_parameters():
+            end_index = start_index + param.numel()
+            self.names.append(name)
+            self.shapes.append(tuple(param.shape))
+            self.slices.append((start_index, end_index))
+            start_index = end_index
+        self.d = start_index
+
+    def flatten(self, model, out=None):
+        with torch.no_grad():
+            params = [param.detach().reshape(-1) for param in model.parameters()]
+            if out is None:
+                return torch.cat(params).float()
+            return torch.cat(params, out=out)
+
+    def unflatten(self, arr):
+        # name -> views of arr in the parameter shapes, a leading dim of arr is kept
+        lead = tuple(arr.shape[:-1])
+        return {name: arr[..., start_index:end_index].reshape(lead + shape)
+                for name, shape, (start_index, end_index) in zip(self.names, self.shapes, self.slices)}
+
+    def assign(self, model, arr, alpha=None):
+        # model params = arr, or model params += alpha * arr
+        arr = torch.as_tensor(arr).reshape(-1)
+        with torch.no_grad():
+            for param, (start_index, end_index) in zip(model.parameters(), self.slices):
+                value = arr[start_index:end_index].view(param.shape)
+                if alpha is None:
+                    param.copy_(value)
+                else:
+                    param.add_(value.to(param.dtype), alpha=alpha)
+        return model
+
+_layouts = {}
+
 def cosine_similarity(arr1, arr2):
     #cs = mnd.dot(mnd.array(arr1), mnd.array(arr2)) / (mnd.norm(mnd.array(arr1)) + 1e-9) / (mnd.norm(mnd.array(arr2)) + 1e-9)
     #return cs.asnumpy()[0]
@@ -67,31 +112,17 @@ def eucliden_dist(arr1, arr2):
     return nd.linalg.norm(arr1-arr2)
     
 def get_arr_net(_model, arr, slist):
-    arr = torch.from_numpy(arr).unsqueeze(1)
-    arr = arr.numpy()
-    
-    _param_list = []
-    start_index = 0
-    for shape in slist:
-        end_index = start_index + nd.prod(list(shape))
-        item = arr[start_index:end_index]
-        start_index = end_index
-        item = item.reshape(shape)
-        _param_list.append(item)
-    
-    params = _model.state_dict().copy()
-    with torch.no_grad():
-        _index = 0
-        for name in params:
-            if "weight" in name or "bias" in name:
-                params[name] = torch.from_numpy(_param_list[_index])
-                _index = _index + 1
-
     model = copy.deepcopy(_model)
-    model.load_state_dict(params, strict=False)
-
+    set_net_arr(model, arr)
     return model
 
+def get_layout(model):
+    # one layout per architecture, keyed by class and parameter shapes
+    key = (type(model), tuple(tuple(param.shape) for param in model.parameters()))
+    if key not in _layouts:
+        _layouts[key] = Layout(model)
+    return _layouts[key]
+
 def get_mx_net_arr(model):
     param_list = [param.data.numpy() for param in model.parameters()]
     _param_list = nd.array(param_list).squeeze()
@@ -109,21 +140,45 @@ def get_mx_net_arr(model):
     return arr
 
 def get_net_arr(model):
-    param_list = [param.data.numpy() for param in model.parameters()]
+    layout = get_layout(model)
+    return layout.flatten(model).numpy(), list(layout.shapes)
 
-    arr = nd.array([[]])
-    slist = []
-    for index, item in enumerate(param_list):
-        slist.append(item.shape)
-        item = item.reshape((-1, 1))
-        if index == 0:
-            arr = item
-        else:
-            arr = nd.concatenate((arr, item), axis=0)
+def gram(arr, block_size=1024, chunk_size=None):
+    # arr @ arr.T of an n x d tensor in float64, accumulated over coordinate chunks of about
+    # 2^22 entries and row blocks, so float32 rounding doesn't cancel into the distances
+    n, d = arr.shape
+    if chunk_size is None:
+        chunk_size = max(1, (1 << 22) // n)
+    _gram = torch.zeros((n, n), dtype=torch.float64)
+    for start_chunk in range(0, d, chunk_size):
+        chunk = arr[:, start_chunk:start_chunk + chunk_size].double()
+        for start_index in range(0, n, block_size):
+            end_index = min(start_index + block_size, n)
+            _gram[start_index:end_index].addmm_(chunk[start_index:end_index], chunk.t())
+    return _gram
 
-    arr = nd.array(arr).squeeze()
-    
-    return arr, slist
+def gram_sq_dists(_gram):
+    # ||a||^2 + ||b||^2 - 2ab, clamped against float cancellation
+    sq_norms = torch.diagonal(_gram)
+    sq_dists = (sq_norms[:, None] + sq_norms[None, :] - 2 * _gram).clamp_(min=0)
+    sq_dists.fill_diagonal_(0)
+    return sq_dists
+
+def top_singular_vector(arr, niter=100, tol=1e-7):
+    # top right singular vector of an n x b arr, power iteration on arr^T arr
+    v = arr[torch.argmax(torch.norm(arr, dim=1))]
+    if torch.norm(v) == 0:
+        # all zero arr, no direction, every projection onto it is 0
+        return torch.zeros_like(v)
+    v = v / torch.norm(v)
+    for _ in range(niter):
+        _v = torch.mv(arr.t(), torch.mv(arr, v))
+        _v = _v / torch.norm(_v)
+        converged = 1 - torch.abs(torch.dot(_v, v)) < tol
+        v = _v
+        if converged:
+            break
+    return v
 
 def grad_cosine_similarity(model1, model2):
     arr1, _ = get_net_arr(model1)
@@ -160,6 +215,10 @@ def norm(arr):
     #return mnd.norm(mnd.array(arr)).asnumpy()[0]
     return nd.linalg.norm(arr)
 
+def set_net_arr(model, arr):
+    get_layout(model).assign(model, arr)
+    return model
+
 def ssd(arr1, arr2):
     return sum((arr1-arr2)**2)
 
@@ -0,0 +1,123 @@
+import torch
+import torch.nn.functional as F
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    # torch 1.12 with functorch
+    from functorch import vmap
+    from torch.nn.utils.stateless import functional_call
+
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../")))
+from libs import sim
+
+# Many models of one architecture run as one, over parameters stacked along a
+# leading client dimension, e.g. the rows of an agg.UpdateMatrix.
+
+def forward(template, params, x, chunk_size=None):
+    # output of every stacked model on the same batch x, n x batch x ...
+    buffers = dict(template.named_buffers())
+    n = next(iter(params.values())).shape[0]
+    chunk_size = n if chunk_size is None else chunk_size
+
+    def _forward(_params):
+        return functional_call(template, {**_params, **buffers}, (x,))
+
+    outputs = []
+    for start_index in range(0, n, chunk_size):
+        _params = {name: param[start_index:start_index + chunk_size] for name, param in params.items()}
+        outputs.append(vmap(_forward)(_params))
+    return torch.cat(outputs)
+
+def evaluate_labels(template, arr, x, y, labels, chunk_size=None):
+    # label wise loss, -log(max(p_true, 1e-4)), and accuracy of each row of arr, n x labels
+    training = template.training
+    template.eval()
+    try:
+        with torch.no_grad():
+            preds = forward(template, sim.get_layout(template).unflatten(arr), x, chunk_size)
+    finally:
+        template.train(training)
+
+    n = preds.shape[0]
+    y = y.long()
+    p_true = preds.gather(2, y[None, :, None].expand(n, -1, 1)).squeeze(2).double()
+    loss = -torch.log(torch.clamp(p_true, min=0.0001))
+    correct = (preds.argmax(2) == y[None, :]).double()
+
+    # labels missing from the batch have 0 loss and accuracy rather than 0 / 0
+    counts = torch.bincount(y, minlength=labels).double().clamp_(min=1)
+    label_loss = torch.zeros((n, labels), dtype=torch.float64).index_add_(1, y, loss) / counts
+    label_accuracy = torch.zeros((n, labels), dtype=torch.float64).index_add_(1, y, correct) / counts
+    return label_loss, label_accuracy
+
+def train(template, train_loaders, lr, wd, epochs, device, chunk_size=None, betas=(0.9, 0.999), eps=1e-8):
+    # local training of every client of train_loaders at once, from the template's weights,
+    # as fl.client_update does one by one (cross entropy, Adam with L2 weight decay per client).
+    # returns the n x d trained weights in train_loaders order and {client: {"Epoch e": loss}}
+    clients = list(train_loaders.keys())
+    layout = sim.get_layout(template)
+    buffers = dict(template.named_buffers())
+    n = len(clients)
+    chunk_size = n if chunk_size is None else chunk_size
+
+    arr = layout.flatten(template).to(device).repeat(n, 1).requires_grad_(True)
+    exp_avg, exp_avg_sq = torch.zeros_like(arr), torch.zeros_like(arr)
+    steps = torch.zeros(n, device=device)
+
+    def _forward(_params, x):
+        return functional_call(template, {**_params, **buffers}, (x,))
+    _vmap = vmap(_forward, randomness="different")
+
+    training = template.training
+    template.train()
+    losses = {client: {} for client in clients}
+    try:
+        for epoch in range(epochs):
+            iterators = [iter(train_loaders[client]) for client in clients]
+            active = list(range(n))
+            while active:
+                # next batch of every client still in the epoch, grouped by batch shape to stack them
+                groups, _active = {}, []
+                for index in active:
+                    try:
+                        data, target = next(iterators[index])
+                    except StopIteration:
+                        continue
+                    _active.append(index)
+                    groups.setdefault((tuple(data.shape), tuple(target.shape)), []).append((index, data, target))
+                active = _active
+                if not active:
+                    break
+
+                arr.grad = None
+                for group in groups.values():
+                    for start_index in range(0, len(group), chunk_size):
+                        batch = group[start_index:start_index + chunk_size]
+                        indices = torch.tensor([index for index, _, _ in batch], device=device)
+                        x = torch.stack([data for _, data, _ in batch]).to(device)
+                        y = torch.stack([target for _, _, target in batch]).to(device)
+
+                        output = _vmap(layout.unflatten(arr[indices]), x)
+                        _loss = F.cross_entropy(output.flatten(0, 1), y.flatten(), reduction="none").view(y.shape).mean(1)
+                        # clients are independent, so the sum backpropagates each loss to its own row
+                        _loss.sum().backward()
+                        for (index, _, _), loss in zip(batch, _loss.tolist()):
+                            losses[clients[index]]["Epoch " + str(epoch + 1)] = loss
+
+                # torch.optim.Adam, one step per active client
+                indices = torch.tensor(active, device=device)
+                with torch.no_grad():
+                    grad = arr.grad[indices] + wd * arr[indices]
+                    steps[indices] += 1
+                    exp_avg[indices] = exp_avg[indices] * betas[0] + grad * (1 - betas[0])
+                    exp_avg_sq[indices] = exp_avg_sq[indices] * betas[1] + grad * grad * (1 - betas[1])
+                    bias_correction1 = (1 - betas[0] ** steps[indices])[:, None]
+                    bias_correction2 = (1 - betas[1] ** steps[indices])[:, None]
+                    denom = exp_avg_sq[indices].sqrt() / bias_correction2.sqrt() + eps
+                    arr[indices] -= lr * exp_avg[indices] / bias_correction1 / denom
+    finally:
+        template.train(training)
+
+    return arr.detach(), losses
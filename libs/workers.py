@@ -0,0 +1,196 @@
+import copy, hashlib, queue, random, time, torch
+import multiprocessing
+import numpy as np
+import torch.multiprocessing
+from threading import Lock, local
+from torch.multiprocessing import Pool
+
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../")))
+from libs import fl, sim
+
+# Client execution backends behind the FedArgs.train_func contract,
+#   model_update, model, loss = train_func(model, train_loader, lr, wd, local_rounds, device)
+# so fedargs.train_func = trainer.train_func runs clients on a persistent
+# process pool instead of the default asyncio thread executor. The trained
+# model is not built, callers only use the update, so model is None.
+#
+# Every client task is seeded from (seed, round, client): its loader shuffles
+# with its own generator, and on the process backend, where a worker runs one
+# task at a time, torch, numpy and random are seeded too. Process runs are so
+# reproducible whatever worker a client lands on. Thread backend tasks share
+# torch's global RNG, so there only the data order is, random layers such as
+# dropout are not.
+
+class Broadcast():
+    '''Global flat weights in shared memory, published once per round.
+
+    version is the round the weights belong to, and updates holds one flat
+    slot per task in flight that the thread or process training it writes
+    into, so shared memory grows with the workers and not the clients.
+    Publishing and materializing share a lock, so a version can be
+    published while clients of an older one still train, as in fl.Buffered.
+    '''
+    def __init__(self, model, slots):
+        self.layout = sim.get_layout(model)
+        self.weights = torch.zeros(self.layout.d).share_memory_()
+        self.version = torch.full((1,), -1, dtype=torch.long).share_memory_()
+        self.updates = torch.zeros((slots, self.layout.d)).share_memory_()
+        self.lock = torch.multiprocessing.Lock()
+
+    def publish(self, model, version):
+        with self.lock:
+            self.layout.flatten(model, self.weights)
+            self.version.fill_(version)
+
+    def materialize(self, model):
+        # a single in place copy into a resident working model, returns its version
+        with self.lock:
+            self.layout.assign(model, self.weights)
+            return int(self.version.item())
+
+    def write(self, slot, model_update):
+        self.layout.flatten(model_update, self.updates[slot])
+
+_worker = {}
+
+def task_seed(seed, version, client):
+    return int(hashlib.sha1("{} {} {}".format(seed, version, client).encode()).hexdigest()[:8], 16)
+
+def seed_loader(train_loader, seed):
+    # a generator of the loader's own for its shuffles, DataLoader or data.BatchLoader
+    generator = torch.Generator().manual_seed(seed)
+    train_loader.generator = generator
+    if isinstance(getattr(train_loader, "sampler", None), torch.utils.data.RandomSampler):
+        train_loader.sampler.generator = generator
+
+def _init_worker(model, train_loaders, train_func, broadcast, threads):
+    # once per worker process, the DataLoaders and the working model stay resident across rounds
+    torch.set_num_threads(threads)
+    _worker["model"] = copy.deepcopy(model)
+    _worker["train_loaders"] = train_loaders
+    _worker["train_func"] = train_func
+    _worker["broadcast"] = broadcast
+
+def _train(model, broadcast, version, slot, buffers, train_func, train_loader, lr, wd, local_rounds, device):
+    if broadcast.materialize(model) < version:
+        raise RuntimeError("Broadcast is behind round {}".format(version))
+    model.load_state_dict(buffers, strict=False)
+
+    if train_func is not fl.train_model:
+        model_update, _, loss = train_func(model, train_loader, lr, wd, local_rounds, device)
+        broadcast.write(slot, model_update)
+        return {name: buffer for name, buffer in model_update.named_buffers()}, loss
+
+    # fl.train_model without its model copies, the working model trains in place and
+    # the slot goes from the weights it started from to those minus the trained ones
+    broadcast.layout.flatten(model, broadcast.updates[slot])
+    _, loss = fl.client_update(model, train_loader, lr, wd, local_rounds, device, inplace=True)
+    broadcast.updates[slot].sub_(broadcast.layout.flatten(model))
+    return {name: buffers[name] - buffer for name, buffer in model.named_buffers() if name in buffers}, loss
+
+def _train_client(client, version, slot, buffers, lr, wd, local_rounds, device, seed):
+    # the worker runs one task at a time, its global RNGs are the task's own
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    seed_loader(_worker["train_loaders"][client], seed)
+    return _train(_worker["model"], _worker["broadcast"], version, slot, buffers, _worker["train_func"],
+                  _worker["train_loaders"][client], lr, wd, local_rounds, device)
+
+class ClientTrainer():
+    '''Runs fedargs.train_func for the clients of train_loaders on a backend.
+
+    begin_round publishes the global weights once into a Broadcast, every
+    client then trains from them and writes its flat update into a shared
+    slot it holds for the task, so no nn.Module is copied per client or
+    pickled. backend "process" keeps a pool of `processes` workers, each
+    limited to `threads` torch threads and holding every client's
+    DataLoader. backend "thread" trains in the caller's thread, as the
+    notebooks do today, on one working model per thread, and takes any
+    loader, e.g. one built for the round, not only those of train_loaders. `slots` caps the
+    clients in flight, by default one per process, or one per thread of the
+    default asyncio executor. Tasks are seeded from seed, by default the
+    caller's torch seed, the round and the client, which train_func finds
+    by its loader or takes as client. throughput() reports clients per
+    second for either.
+    '''
+    def __init__(self, model, train_loaders, train_func, backend="process", processes=None, threads=1, slots=None,
+                 seed=None):
+        self.template = copy.deepcopy(model)
+        self.train_func_ = train_func
+        self.backend = backend
+        # notebooks pass the loader object, the client is looked up by it
+        self.clients = {id(loader): client for client, loader in train_loaders.items()}
+        if slots is None:
+            if backend == "process":
+                slots = processes if processes is not None else max(1, multiprocessing.cpu_count() // threads)
+            else:
+                slots = min(32, multiprocessing.cpu_count() + 4)
+        self.broadcast = Broadcast(model, slots)
+        self.slots = queue.Queue()
+        for slot in range(slots):
+            self.slots.put(slot)
+        self.version, self.buffers = None, {}
+        self.local = local()
+        self.pool = None
+        if backend == "process":
+            processes = processes if processes is not None else max(1, multiprocessing.cpu_count() // threads)
+            self.pool = Pool(processes, initializer=_init_worker,
+                             initargs=(model, train_loaders, train_func, self.broadcast, threads))
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.trained = 0
+        self.start_time = None
+
+    def throughput(self):
+        if self.start_time is None:
+            return 0.0
+        return self.trained / (time.time() - self.start_time)
+
+    def begin_round(self, global_model, version):
+        self.broadcast.publish(global_model, version)
+        self.buffers = {name: buffer for name, buffer in global_model.named_buffers()}
+        self.version = version
+
+    def train_func(self, _model, train_loader, lr, wd, local_rounds, device, client=None):
+        # _model only stands for the global model, whose weights come from the broadcast
+        if self.version is None:
+            raise ValueError("begin_round before training clients")
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+
+        client = self.clients.get(id(train_loader), client)
+        if self.pool is not None and id(train_loader) not in self.clients:
+            raise ValueError("the process backend only trains the loaders it was created with")
+        # held until the update is copied out of it, waits while all slots are in flight
+        slot = self.slots.get()
+        try:
+            if self.pool is None:
+                if not hasattr(self.local, "model"):
+                    self.local.model = copy.deepcopy(self.template)
+                if client is not None:
+                    seed_loader(train_loader, task_seed(self.seed, self.version, client))
+                update_buffers, loss = _train(self.local.model, self.broadcast, self.version, slot, self.buffers,
+                                              self.train_func_, train_loader, lr, wd, local_rounds, device)
+            else:
+                update_buffers, loss = self.pool.apply(_train_client, (client, self.version, slot, self.buffers,
+                                                                       lr, wd, local_rounds, device,
+                                                                       task_seed(self.seed, self.version, client)))
+            model_update = sim.get_arr_net(self.template, self.broadcast.updates[slot], None)
+        finally:
+            self.slots.put(slot)
+        model_update.load_state_dict(update_buffers, strict=False)
+
+        with self.lock:
+            self.trained += 1
+        return model_update, None, loss
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
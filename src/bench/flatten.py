@@ -0,0 +1,70 @@
+import copy, time
+import numpy as np
+import torch
+
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+from libs import nn, resnet, sim
+
+# Flatten / unflatten cost of sim.get_net_arr and sim.get_arr_net, against the
+# previous concatenate-in-a-loop and deepcopy + load_state_dict versions.
+# Run from src/bench: python flatten.py
+
+def legacy_get_net_arr(model):
+    param_list = [param.data.numpy() for param in model.parameters()]
+    arr = np.array([[]])
+    slist = []
+    for index, item in enumerate(param_list):
+        slist.append(item.shape)
+        item = item.reshape((-1, 1))
+        if index == 0:
+            arr = item
+        else:
+            arr = np.concatenate((arr, item), axis=0)
+    return np.array(arr).squeeze(), slist
+
+def legacy_get_arr_net(_model, arr, slist):
+    arr = torch.from_numpy(arr).unsqueeze(1).numpy()
+    _param_list = []
+    start_index = 0
+    for shape in slist:
+        end_index = start_index + np.prod(list(shape))
+        _param_list.append(arr[start_index:end_index].reshape(shape))
+        start_index = end_index
+    params = _model.state_dict().copy()
+    _index = 0
+    for name in params:
+        if "weight" in name or "bias" in name:
+            params[name] = torch.from_numpy(_param_list[_index])
+            _index = _index + 1
+    model = copy.deepcopy(_model)
+    model.load_state_dict(params, strict=False)
+    return model
+
+def timeit(func, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start_time) / repeat * 1000
+
+def bench(name, model, repeat=5):
+    arr, slist = sim.get_net_arr(model)
+    assert np.array_equal(arr, legacy_get_net_arr(model)[0])
+
+    target = copy.deepcopy(model)
+    results = {
+        "legacy flatten": timeit(lambda: legacy_get_net_arr(model), repeat),
+        "flatten": timeit(lambda: sim.get_net_arr(model), repeat),
+        "legacy unflatten": timeit(lambda: legacy_get_arr_net(model, arr, slist), repeat),
+        "unflatten": timeit(lambda: sim.get_arr_net(model, arr, slist), repeat),
+        "in place": timeit(lambda: sim.set_net_arr(target, arr), repeat),
+    }
+    print("{:<12} {:>10} params | ".format(name, len(arr)) +
+          " | ".join("{} {:.1f} ms".format(key, value) for key, value in results.items()))
+
+if __name__ == "__main__":
+    torch.set_grad_enabled(False)
+    bench("ModelMNIST", nn.ModelMNIST())
+    bench("ResNet18", resnet.ResNet18())
+    bench("ResNet34", resnet.ResNet34())
+    bench("ResNet50", resnet.ResNet50())
@@ -0,0 +1,79 @@
+import time
+import numpy as np
+import torch
+
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+from libs import agg, sim
+
+# Coordinate-wise Median, T_Mean and FLTC against the previous per-coordinate
+# loops. Run from src/bench: python robust.py [coordinates] [chunk_size]
+# Median must match np.median exactly. T_Mean sums in a different order than
+# numpy's pairwise mean, so it is held to float32 rounding, T_MEAN_TOL. FLTC
+# works in float64 while agg.FLTC_reference takes distances and differences
+# in float32, so it is held to FLTC_TOL, on fewer coordinates as the
+# reference runs one pool task per coordinate.
+
+T_MEAN_TOL = {"rtol": 1e-5, "atol": 1e-6}
+FLTC_TOL = {"rtol": 1e-4, "atol": 1e-5}
+
+def legacy_median(arr):
+    merged = torch.transpose(torch.sort(arr, dim = 0).values, 0, 1).numpy()
+    model_arr = np.zeros(arr.shape[1], dtype=np.float32)
+    for index, _arr in enumerate(merged):
+        model_arr[index] = np.median(_arr)
+    return torch.from_numpy(model_arr)
+
+def legacy_t_mean(arr, beta):
+    merged = torch.transpose(torch.sort(arr, dim = 0).values, 0, 1).numpy()
+    model_arr = np.zeros(arr.shape[1], dtype=np.float32)
+    for index, _arr in enumerate(merged):
+        model_arr[index] = _arr[beta:arr.shape[0] - beta].mean(0)
+    return torch.from_numpy(model_arr)
+
+def timeit(func):
+    start_time = time.perf_counter()
+    output = func()
+    return output, time.perf_counter() - start_time
+
+def bench(n, d, chunk_size):
+    torch.manual_seed(n)
+    template = torch.nn.Linear(d, 1, bias=False)
+    um = agg.UpdateMatrix.from_arr(torch.randn(n, d), template)
+    beta = max(1, n // 10)
+    avgargs = {"beta": beta, "chunk_size": chunk_size}
+
+    median, median_time = timeit(lambda: agg.Median(None, um, **avgargs))
+    t_mean, t_mean_time = timeit(lambda: agg.T_Mean(None, um, **avgargs))
+    median, t_mean = um.flatten(median), um.flatten(t_mean)
+
+    _median, _median_time = timeit(lambda: legacy_median(um.arr))
+    _t_mean, _t_mean_time = timeit(lambda: legacy_t_mean(um.arr, beta))
+
+    print("n {:>5} d {} | Median {:.2f}s (legacy {:.2f}s, equal {}) | T_Mean {:.2f}s (legacy {:.2f}s, max diff {:.2e})".format(
+        n, d, median_time, _median_time, torch.equal(median, _median),
+        t_mean_time, _t_mean_time, (t_mean - _t_mean).abs().max().item()))
+    assert torch.equal(median, _median), "Median differs from the legacy loop for n {}".format(n)
+    assert torch.allclose(t_mean, _t_mean, **T_MEAN_TOL), "T_Mean differs from the legacy loop for n {}".format(n)
+
+def bench_fltc(n, d, chunk_size):
+    torch.manual_seed(n)
+    template = torch.nn.Linear(d, 1, bias=False)
+    um = agg.UpdateMatrix.from_arr(torch.randn(n, d), template)
+    avgargs = {"base_model_update": sim.get_arr_net(template, torch.randn(d), None), "chunk_size": chunk_size}
+
+    fltc, fltc_time = timeit(lambda: agg.FLTC(None, um, **avgargs))
+    _fltc, _fltc_time = timeit(lambda: agg.FLTC_reference(None, um, **avgargs))
+    fltc, _fltc = um.flatten(fltc), um.flatten(_fltc)
+
+    print("n {:>5} d {} | FLTC {:.2f}s (reference {:.2f}s, max diff {:.2e})".format(
+        n, d, fltc_time, _fltc_time, (fltc - _fltc).abs().max().item()))
+    assert torch.allclose(fltc, _fltc, **FLTC_TOL), "FLTC differs from FLTC_reference for n {}".format(n)
+
+if __name__ == "__main__":
+    d = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    for n in [10, 100, 1000]:
+        bench(n, d, chunk_size)
+    for n in [10, 50]:
+        bench_fltc(n, min(d, 2000), chunk_size)
@@ -0,0 +1,99 @@
+import copy, csv, itertools, json, multiprocessing, os, subprocess, sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Sweeps of src/run.py over a grid of configs, each run in its own process.
+# From the repo root:
+#   python -m src.grid sweep.json [out_root]
+#
+# {"base": {"name": "mnist", "dataset": "mnist", "num_clients": 10, "epochs": 21, "mal_clients": 3},
+#  "grid": {"agg_rule": ["FedAvg", "Krum", "T_Mean", "FLTrust"],
+#           "lie_attack.is": [false, true],
+#           "label_flip_attack.percent": [0.2, 0.5]},
+#  "concurrency": 8, "threads": 2}
+#
+# A dotted grid key sets a key of an attack dict. Every point of the grid is a
+# run in out_root/<name>, at most concurrency at once (default cores //
+# threads), each limited to threads torch/OpenMP threads. Runs with a
+# summary.json are finished and skipped, the rest start over or resume from
+# their checkpoint. The last metrics of every run end up in out_root/results.csv.
+
+def expand(spec):
+    # one config per point of the grid, named by the base name and the grid values
+    keys = list(spec["grid"].keys())
+    for values in itertools.product(*[spec["grid"][key] for key in keys]):
+        config = copy.deepcopy(spec["base"])
+        for key, value in zip(keys, values):
+            target = config
+            *path, leaf = key.split(".")
+            for part in path:
+                target = target.setdefault(part, {})
+            target[leaf] = value
+        point = dict(zip(keys, values))
+        config["name"] = "-".join([spec["base"].get("name", "run")] +
+                                  [key.replace("_attack", "").replace(".is", "").replace(".", "_") + "=" + str(value)
+                                   for key, value in point.items()])
+        yield config, point
+
+def execute(config, out_dir, threads):
+    os.makedirs(out_dir, exist_ok=True)
+    config_path = os.path.join(out_dir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=1)
+
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+    with open(os.path.join(out_dir, "run.out"), "w") as out:
+        process = subprocess.run([sys.executable, "-m", "src.run", config_path, out_dir],
+                                 cwd=root, env=env, stdout=out, stderr=subprocess.STDOUT)
+    return process.returncode
+
+def run(spec, out_root):
+    threads = spec.get("threads", 1)
+    concurrency = spec.get("concurrency", max(1, multiprocessing.cpu_count() // threads))
+
+    runs, pending = [], []
+    for config, point in expand(spec):
+        config.setdefault("torch_threads", threads)
+        config.setdefault("threads", threads)
+        out_dir = os.path.join(out_root, config["name"])
+        runs.append((config["name"], point, out_dir))
+        if os.path.isfile(os.path.join(out_dir, "summary.json")):
+            print("Skipping finished {}".format(config["name"]))
+        else:
+            pending.append((config, out_dir))
+
+    print("{} runs, {} to go, {} at once".format(len(runs), len(pending), concurrency))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        codes = executor.map(lambda args: execute(*args, threads), pending)
+        for (config, _), code in zip(pending, codes):
+            print("{} {}".format(config["name"], "done" if code == 0 else "failed with {}".format(code)))
+
+    return collect(runs, out_root)
+
+def collect(runs, out_root):
+    # one row per run, its grid point and the last metrics it logged
+    rows = []
+    for name, point, out_dir in runs:
+        row = {"name": name, **point}
+        summary_path = os.path.join(out_dir, "summary.json")
+        if os.path.isfile(summary_path):
+            with open(summary_path) as f:
+                row.update(json.load(f))
+        rows.append(row)
+
+    fields = []
+    for row in rows:
+        fields.extend([field for field in row if field not in fields])
+    with open(os.path.join(out_root, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as f:
+        spec = json.load(f)
+    out_root = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "../out/results",
+                                                                  spec["base"].get("name", "sweep"))
+    os.makedirs(out_root, exist_ok=True)
+    run(spec, out_root)
@@ -0,0 +1,364 @@
+import asyncio, copy, csv, enum, hashlib, json, os, sys, time
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../")))
+from libs import agg, checkpoint, data, fl, log, nn, poison, registry, replay, resnet, workers
+from cfgs import fedargs as cfgs
+
+# Headless federated training, the round loop of src/fl-poison.ipynb driven
+# by a declarative JSON config. From the repo root:
+#   python -m src.run config.json [out_dir]
+#
+# {"name": "fltrust-cnn-fmnist-lie",
+#  "dataset": "fmnist", "model": "ModelMNIST", "agg_rule": "FLTrust",
+#  "num_clients": 10, "epochs": 21, "mal_clients": 3,
+#  "FLTrust": {"is": true, "proxy": {"is": true}},
+#  "lie_attack": {"is": true, "kn": "PN"},
+#  "backend": "process", "processes": 8, "threads": 1}
+#
+# FedArgs fields are set by name, the attack and FLTrust dicts of
+# cfgs/fedargs.py are updated key by key. Enums and functions are given by
+# name, and "flip_labels" goes through set_lfa_labels. "partition", e.g.
+# {"method": "dirichlet", "alpha": 0.5, "min_size": 10}, splits the data with
+# data.partition_data instead of data.split_data. "in_memory": true keeps
+# MNIST, FMNIST or CIFAR10 as uint8 tensors, see data.load_tensor_dataset,
+# MedNIST and CelebA as memory-mapped uint8 caches, see data.cache_images,
+# and trains clients on data.BatchLoaders. Metrics of every
+# epoch are written to out_dir/metrics.json and metrics.csv.
+# Every "checkpoint_every" epochs (default 1) the run is checkpointed to
+# out_dir/checkpoint.pkl, and a run started on an out_dir with a checkpoint
+# resumes from it. Client tasks are seeded by round and client, see
+# libs/workers.py, so on the process backend the resumed run trains as the
+# uninterrupted one would. On the thread backend client data order is
+# reproduced, random layers such as dropout are not.
+# With "replay": dir, honest client updates are recorded in and replayed from
+# a replay.UpdateCache there, shared by the runs of a sweep. A finished run
+# writes its last metrics to out_dir/summary.json, see src/grid.py.
+# With "client_fraction": C below 1, every epoch trains max(C * K, 1) of the
+# K clients, drawn by registry.Registry.sample from [seed, epoch], and the
+# model poisoning attacks act through the malicious clients drawn. On the
+# thread backend an honest client's loader is built from the Registry only
+# while it trains, so memory follows the clients per round, not all K.
+# FoolsGold weighs clients by an agg.FoolsGoldHistory of all their updates,
+# checkpointed with the run, memory-mapped to out_dir/foolsgold.npy with
+# "foolsgold_mmap": true.
+
+# config keys that don't change what honest clients train on or how, left out of the replay split
+REPLAY_FREE = ["name", "epochs", "seed", "agg_rule", "mal_clients", "fang_attack", "lie_attack", "sota_attack",
+               "cosine_attack", "sybil_attack", "layer_replacement_attack", "backend", "processes", "threads",
+               "checkpoint_every", "log", "replay", "torch_threads", "client_fraction",
+               "foolsgold_mmap"]
+
+def replay_split(config, fedargs, FLTrust):
+    split = [{key: value for key, value in config.items() if key not in REPLAY_FREE}, FLTrust["is"], FLTrust["proxy"]["is"]]
+    return fedargs.dataset + "-" + hashlib.sha1(json.dumps(split, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def resolve(value, default):
+    # names in the config stand for the enum member or function the default is one of
+    if isinstance(value, str) and isinstance(default, enum.Enum):
+        return type(default)[value]
+    if isinstance(value, str) and callable(default) and not isinstance(default, type):
+        return getattr(sys.modules[default.__module__], value)
+    return value
+
+def update(target, config):
+    for key, value in config.items():
+        if isinstance(target.get(key), dict) and isinstance(value, dict):
+            update(target[key], value)
+        else:
+            target[key] = resolve(value, target.get(key))
+
+def build_model(name, args):
+    module = nn if hasattr(nn, name) else resnet
+    return getattr(module, name)(*args)
+
+def configure(config):
+    fedargs = cfgs.fedargs
+    for key, value in config.items():
+        if key == "model":
+            fedargs.model = build_model(value, config.get("model_args", []))
+        elif key in ["train_func", "eval_func"]:
+            setattr(fedargs, key, getattr(fl, value))
+        elif key == "mal_clients":
+            cfgs.mal_clients = [client for client in range(value)] if isinstance(value, int) else value
+        elif key == "flip_labels":
+            cfgs.set_lfa_labels({int(source): target for source, target in value.items()} if isinstance(value, dict) else value)
+        elif hasattr(fedargs, key):
+            setattr(fedargs, key, resolve(value, getattr(fedargs, key)))
+        elif isinstance(getattr(cfgs, key, None), dict):
+            update(getattr(cfgs, key), value)
+
+    if "FLTrust" not in config:
+        cfgs.FLTrust["is"] = fedargs.agg_rule in [agg.Rule.FLTrust, agg.Rule.FLTC, agg.Rule.FedVal]
+    attacks = ["label_flip_attack", "backdoor_attack", "layer_replacement_attack", "cosine_attack", "fang_attack",
+               "lie_attack", "sota_attack", "sybil_attack"]
+    out_of_range = [client for client in cfgs.mal_clients if client >= fedargs.num_clients]
+    if out_of_range and any(getattr(cfgs, attack)["is"] for attack in attacks):
+        raise ValueError("mal_clients {} out of range for {} clients".format(out_of_range, fedargs.num_clients))
+    if cfgs.lie_attack["is"] and cfgs.lie_attack["func"] is poison.lie_attack and len(cfgs.mal_clients) not in poison.lie_z_values:
+        raise ValueError("lie_attack needs mal_clients in {}, got {}".format(sorted(poison.lie_z_values), len(cfgs.mal_clients)))
+    if cfgs.lie_attack["is"] and cfgs.lie_attack["func"] is poison.lie_attack and fedargs.client_fraction < 1:
+        raise ValueError("lie_attack needs every malicious client in every round, client_fraction must be 1")
+    return fedargs
+
+def write_metrics(out_dir, metrics):
+    with open(os.path.join(out_dir, "metrics.json"), "w") as f:
+        json.dump(metrics, f, indent=1)
+
+    fields = []
+    for row in metrics:
+        fields.extend([field for field in row if field not in fields])
+    with open(os.path.join(out_dir, "metrics.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(metrics)
+
+def run(config, out_dir):
+    fedargs = configure(config)
+    FLTrust, mal_clients = cfgs.FLTrust, cfgs.mal_clients
+    label_flip_attack, backdoor_attack = cfgs.label_flip_attack, cfgs.backdoor_attack
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=1)
+    log.init(config.get("log", "info"), config.get("name", fedargs.name))
+
+    # Device settings
+    use_cuda = fedargs.cuda and torch.cuda.is_available()
+    torch.manual_seed(fedargs.seed)
+    if "torch_threads" in config:
+        torch.set_num_threads(config["torch_threads"])
+    device = torch.device("cuda" if use_cuda else "cpu")
+    kwargs = {"num_workers": 1, "pin_memory": True} if use_cuda else {}
+
+    # Prepare clients, data and the attacks on it
+    clients = ["client(" + str(client + 1) + ")" for client in range(fedargs.num_clients)]
+    global_model = copy.deepcopy(fedargs.model)
+    if config.get("in_memory", False) and fedargs.dataset.upper() in ["MEDNIST", "CELEBA"]:
+        train_data, test_data = data.load_dataset(fedargs.dataset, cached=True)
+    elif config.get("in_memory", False):
+        train_data, test_data = data.load_tensor_dataset(fedargs.dataset)
+    else:
+        train_data, test_data = data.load_dataset(fedargs.dataset)
+
+    if FLTrust["is"]:
+        train_data, FLTrust["data"] = data.random_split(train_data, FLTrust["ratio"])
+        FLTrust["loader"] = torch.utils.data.DataLoader(FLTrust["data"], batch_size=len(FLTrust["data"]), shuffle=True, **kwargs)
+
+        if FLTrust["proxy"]["is"]:
+            FLTrust["data"], FLTrust["proxy"]["data"] = data.random_split(FLTrust["data"], FLTrust["proxy"]["ratio"])
+            FLTrust["loader"] = torch.utils.data.DataLoader(FLTrust["data"], batch_size=fedargs.client_batch_size, shuffle=True, **kwargs)
+            FLTrust["proxy"]["loader"] = torch.utils.data.DataLoader(FLTrust["proxy"]["data"], batch_size=fedargs.client_batch_size, shuffle=True, **kwargs)
+
+    if backdoor_attack["is"]:
+        train_data, backdoor_attack["data"] = data.random_split(train_data, backdoor_attack["ratio"])
+        backdoor_attack["data"] = poison.insert_trojan(backdoor_attack["data"],
+                                                       backdoor_attack["target_label"],
+                                                       backdoor_attack["trojan_func"], 1)
+        backdoor_attack["loader"] = torch.utils.data.DataLoader(backdoor_attack["data"], batch_size=fedargs.client_batch_size, shuffle=True, **kwargs)
+
+    if "partition" in config:
+        clients_data = data.partition_data(train_data, clients, seed=fedargs.seed, name=fedargs.dataset, **config["partition"])
+    else:
+        clients_data = data.split_data(train_data, clients)
+    # the population rounds are sampled from, honest clients' loaders are built from it when they train
+    population = registry.Registry(train_data, clients, {client: clients_data[client].indices for client in clients},
+                                   loader_func=data.load_client_batches if config.get("in_memory", False) else None)
+
+    if cfgs.hdc_dp_attack["is"]:
+        log.warning("hdc_dp_attack needs the HDC models of src/fl-poison.ipynb, skipped")
+
+    if label_flip_attack["is"]:
+        for client in mal_clients:
+            clients_data[clients[client]] = label_flip_attack["func"](clients_data[clients[client]],
+                                                                      label_flip_attack["labels"],
+                                                                      label_flip_attack["percent"])
+
+    if backdoor_attack["is"]:
+        for client in mal_clients:
+            clients_data[clients[client]] = poison.insert_trojan(clients_data[clients[client]],
+                                                                 backdoor_attack["target_label"],
+                                                                 backdoor_attack["trojan_func"], 0.5)
+
+    # the process backend keeps every client's loader in its workers, the thread
+    # backend only the poisoned ones, which the registry doesn't hold
+    backend = config.get("backend", "thread")
+    if backend != "process":
+        data_poisoned = label_flip_attack["is"] or backdoor_attack["is"]
+        clients_data = {clients[client]: clients_data[clients[client]] for client in mal_clients} if data_poisoned else {}
+
+    if config.get("in_memory", False):
+        client_train_loaders = data.load_client_batches(clients_data, fedargs.client_batch_size, **kwargs)
+        test_loader = data.BatchLoader(*data.tensor_indices(test_data), fedargs.test_batch_size, shuffle=False)
+    else:
+        client_train_loaders, _ = data.load_client_data(clients_data, fedargs.client_batch_size, None, **kwargs)
+        test_loader = torch.utils.data.DataLoader(test_data, batch_size=fedargs.test_batch_size, shuffle=True, **kwargs)
+
+    # Clients train on a workers.ClientTrainer, the server side FLTrust updates with fedargs.train_func
+    trainer = workers.ClientTrainer(global_model, client_train_loaders, fedargs.train_func,
+                                    backend=backend,
+                                    processes=config.get("processes", None),
+                                    threads=config.get("threads", 1), seed=fedargs.seed)
+
+    # Honest updates replayed across runs, clients with poisoned data always train
+    cache = None
+    if "replay" in config:
+        cache = replay.UpdateCache(config["replay"], replay_split(config, fedargs, FLTrust), fedargs.seed, global_model)
+    poisoned = []
+    if label_flip_attack["is"] or backdoor_attack["is"]:
+        poisoned = [clients[client] for client in mal_clients]
+
+    def process(client, epoch, model):
+        honest = cache is not None and client not in poisoned
+        if honest:
+            model_update = cache.get(client)
+            if model_update is not None:
+                return model_update
+
+        if client in client_train_loaders:
+            train_loader = client_train_loaders[client]
+        else:
+            train_loader = population.loaders([client], fedargs.client_batch_size, **kwargs)[client]
+        model_update, _, loss = trainer.train_func(model, train_loader,
+                                                   fedargs.learning_rate,
+                                                   fedargs.weight_decay,
+                                                   fedargs.local_rounds, device, client=client)
+        log.jsondebug(loss, "Epoch {} of {} : Federated Training loss, Client {}".format(epoch, fedargs.epochs, client))
+        if honest:
+            cache.put(client, model_update)
+        return model_update
+
+    # Checkpoints are taken after the global model update, before the clients train
+    metrics = []
+    state = {"metrics": metrics, "cosine_attack": cfgs.cosine_attack["args"]}
+    history = None
+    if fedargs.agg_rule is agg.Rule.FoolsGold:
+        history = agg.FoolsGoldHistory(clients, global_model,
+                                       os.path.join(out_dir, "foolsgold.npy") if config.get("foolsgold_mmap", False) else None)
+        state["foolsgold_history"] = history
+    checkpointer = checkpoint.Checkpointer(os.path.join(out_dir, "checkpoint.pkl"), config.get("checkpoint_every", 1))
+    start_epoch = 0
+    if checkpointer.exists():
+        start_epoch, _ = checkpointer.load(global_model, state)
+        metrics = state["metrics"]
+        log.info("Resuming at Epoch {} of {}".format(start_epoch, fedargs.epochs))
+
+    start_time = time.time()
+    try:
+        for epoch in range(start_epoch, fedargs.epochs):
+            log.info("Federated Training Epoch {} of {}".format(epoch, fedargs.epochs))
+
+            # Global Model Update, already in the checkpoint of a resumed epoch
+            if epoch > start_epoch:
+                # For Tmean and FLTrust, not impacts others as of now
+                avgargs = {"beta": n_attackers,
+                           "base_model_update": global_model_update if FLTrust["is"] else None,
+                           "base_norm": True,
+                           "val_data_loader": FLTrust["loader"],
+                           "history": history}
+
+                # a memory-mapped FoolsGold history is still being copied by the last checkpoint
+                checkpointer.wait()
+                global_model = fl.federated_avg(client_model_updates, global_model, fedargs.agg_rule, **avgargs)
+
+                # Test and Log
+                global_test_output = fedargs.eval_func(global_model, test_loader, device, label_flip_attack["labels"])
+                log.jsoninfo(global_test_output, "Global Test Outut after Epoch {} of {}".format(epoch, fedargs.epochs))
+                row = {"epoch": epoch, "time": time.time() - start_time,
+                       "acc": global_test_output["accuracy"], "loss": global_test_output["test_loss"],
+                       "clients_per_second": trainer.throughput()}
+                if cache is not None:
+                    row["replay_hit_rate"] = cache.stats()["hit_rate"]
+
+                if "attack" in global_test_output:
+                    row["attack_success_rate"] = global_test_output["attack"]["attack_success_rate"]
+                    row["misclassification_rate"] = global_test_output["attack"]["misclassification_rate"]
+
+                if backdoor_attack["is"]:
+                    backdoor_test_output = fl.backdoor_test(global_model, backdoor_attack["loader"], device, backdoor_attack["target_label"])
+                    row["backdoor_success_rate"] = backdoor_test_output["accuracy"]
+
+                metrics.append(row)
+                write_metrics(out_dir, metrics)
+
+            checkpointer.save(epoch, global_model, state)
+
+            # Clients
+            trainer.begin_round(global_model, epoch)
+            if cache is not None:
+                cache.begin_round(epoch, global_model)
+            # per epoch draws, so a resumed run samples the same clients
+            round_clients = clients
+            if fedargs.client_fraction < 1:
+                round_clients = population.sample(fedargs.client_fraction, [fedargs.seed, epoch])
+            # in population order, the malicious clients drawn come first as the attacks expect
+            round_mal_clients = [clients[client] for client in mal_clients
+                                 if client < len(clients) and clients[client] in round_clients]
+            n_attackers = len(round_mal_clients)
+
+            tasks = [fedargs.loop.run_in_executor(None, process, client, epoch, global_model) for client in round_clients]
+            updates = fedargs.loop.run_until_complete(asyncio.gather(*tasks))
+            client_model_updates = {client: update for client, update in zip(round_clients, updates)}
+
+            # Fang attack
+            if cfgs.fang_attack["is"] and n_attackers > 0:
+                client_model_updates = cfgs.fang_attack["func"](client_model_updates, n_attackers, cfgs.fang_attack["kn"])
+
+            # LIE attack
+            if cfgs.lie_attack["is"] and n_attackers > 0:
+                client_model_updates = cfgs.lie_attack["func"](client_model_updates, n_attackers, cfgs.lie_attack["kn"])
+
+            # SOTA attack
+            if cfgs.sota_attack["is"] and n_attackers > 0:
+                client_model_updates = cfgs.sota_attack["func"](client_model_updates, n_attackers,
+                                                                cfgs.sota_attack["kn"], cfgs.sota_attack["dev_type"])
+
+            # FLtrust or FLTC based aggregation rules or attacks
+            if FLTrust["is"]:
+                global_model_update, _, _ = fedargs.train_func(global_model, FLTrust["loader"],
+                                                               fedargs.learning_rate,
+                                                               fedargs.weight_decay,
+                                                               fedargs.local_rounds, device)
+
+                # For Attacks related to FLTrust
+                base_model_update = global_model_update
+                if FLTrust["proxy"]["is"]:
+                    base_model_update, _, _ = fedargs.train_func(global_model, FLTrust["proxy"]["loader"],
+                                                                 fedargs.learning_rate,
+                                                                 fedargs.weight_decay,
+                                                                 fedargs.local_rounds, device)
+
+                # Layer replacement attack
+                if cfgs.layer_replacement_attack["is"]:
+                    for client in round_mal_clients:
+                        client_model_updates[client] = cfgs.layer_replacement_attack["func"](base_model_update,
+                                                                                             client_model_updates[client],
+                                                                                             cfgs.layer_replacement_attack["layers"])
+
+                # For cosine attack, Malicious Clients
+                if cfgs.cosine_attack["is"] and n_attackers > 0:
+                    p_models, params_changed = cfgs.cosine_attack["func"](base_model_update, cfgs.cosine_attack["args"], epoch,
+                                                                          client_model_updates, n_attackers, cfgs.cosine_attack["kn"])
+                    for client, p_model in enumerate(p_models):
+                        client_model_updates[round_clients[client]] = p_model
+
+                # For sybil attack, Malicious Clients
+                if cfgs.sybil_attack["is"]:
+                    for client in round_mal_clients:
+                        client_model_updates[client] = base_model_update
+    finally:
+        trainer.close()
+        checkpointer.close()
+
+    log.info("Finished in {} seconds".format(time.time() - start_time))
+    if cache is not None:
+        log.jsoninfo(cache.stats(), "Replay cache")
+    with open(os.path.join(out_dir, "summary.json"), "w") as f:
+        json.dump(metrics[-1] if metrics else {}, f, indent=1)
+    return metrics
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    out_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "../out/results",
+                                                                 config.get("name", cfgs.fedargs.name))
+    run(config, out_dir)